@@ -3,10 +3,28 @@
 支持用户登录注册和AI对话功能
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+import os
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 协程服务模式：使用gevent让等待上游API和数据库的请求让出CPU，
+# 单个进程即可同时处理大量并发请求。补丁必须在导入其他模块之前完成
+ASYNC_MODE = os.getenv("ASYNC_MODE", "").lower() in ('1', 'true', 'gevent')
+if ASYNC_MODE:
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, Response, stream_with_context
+from flask.sessions import SecureCookieSessionInterface
+from flask_session import Session
+from itsdangerous import Signer
 from werkzeug.security import generate_password_hash, check_password_hash
 import mysql.connector
-import os
+from mysql.connector.constants import ClientFlag
+import httpx
+import openai
 import logging
 import sys
 import json
@@ -15,7 +33,7 @@ import uuid
 import re
 import base64
 from werkzeug.utils import secure_filename
-from dotenv import load_dotenv
+from werkzeug.exceptions import RequestEntityTooLarge
 from openai import OpenAI
 import tiktoken
 from PIL import Image
@@ -23,9 +41,29 @@ from io import BytesIO
 import math
 import datetime
 import traceback
-
-# 加载环境变量
-load_dotenv()
+import click
+import hashlib
+import tempfile
+import atexit
+import gzip
+import shutil
+import threading
+import queue
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from contextlib import contextmanager
+import zlib
+from cachelib import FileSystemCache
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # 配置日志
 logging.basicConfig(
@@ -45,6 +83,44 @@ api_base = os.getenv("OPENAI_API_BASE", "https://api.openai-hk.com/v1")
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "tianyan_ai_secret_key")
 
+# 服务端会话存储：cookie中只保存会话ID，对话历史保存在服务端
+# SESSION_TYPE 可选 filesystem / redis / memcached / mongodb / sqlalchemy，
+# 设置为 cookie 时退回Flask默认的签名cookie会话
+SESSION_TYPE = os.getenv("SESSION_TYPE", "filesystem")
+if SESSION_TYPE != 'cookie':
+    app.config['SESSION_TYPE'] = SESSION_TYPE
+    app.config['SESSION_FILE_DIR'] = os.getenv("SESSION_FILE_DIR", os.path.join(app.root_path, 'flask_session'))
+    app.config['SESSION_FILE_THRESHOLD'] = int(os.getenv("SESSION_FILE_THRESHOLD", "10000"))
+    app.config['SESSION_PERMANENT'] = False
+    # 对会话ID签名，拒绝客户端自行指定的会话ID
+    app.config['SESSION_USE_SIGNER'] = True
+    app.config['SESSION_KEY_PREFIX'] = 'tianyan:'
+    if SESSION_TYPE == 'redis':
+        import redis
+        app.config['SESSION_REDIS'] = redis.from_url(os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0"))
+    Session(app)
+
+    class TextSigner(Signer):
+        """Flask-Session 0.5把签名结果(bytes)直接传给set_cookie，Werkzeug 3只接受str"""
+
+        def sign(self, value):
+            return super().sign(value).decode('utf-8')
+
+    def session_signer(app):
+        if not app.secret_key:
+            return None
+        return TextSigner(app.secret_key, salt='flask-session', key_derivation='hmac')
+
+    app.session_interface._get_signer = session_signer
+
+# 登录成功后更换会话ID
+def regenerate_session():
+    """清空登录前的会话数据并分配新的会话ID，防止会话固定攻击"""
+    session.clear()
+    interface = app.session_interface
+    if hasattr(session, 'sid') and hasattr(interface, '_generate_sid'):
+        session.sid = interface._generate_sid()
+
 # MySQL配置
 MYSQL_CONFIG = {
     'host': '192.168.1.184',
@@ -52,30 +128,408 @@ MYSQL_CONFIG = {
     'password': 'root',
     'database': 'tiktoken_limit',
     'pool_name': 'tiktoken_pool',
-    'pool_size': 10  # 连接池大小
+    'pool_size': int(os.getenv("DB_POOL_SIZE", "10")),  # 连接池大小
+    # UPDATE的rowcount返回匹配的行数而不是实际修改的行数，
+    # 带归属条件的更新在值未变化时也能判断记录存在
+    'client_flags': [ClientFlag.FOUND_ROWS]
 }
 
-# 初始化MySQL连接池
+# 协程模式下使用纯Python实现的MySQL驱动，C扩展的网络IO无法被gevent调度
+if ASYNC_MODE:
+    MYSQL_CONFIG['use_pure'] = True
+
+# MySQL连接池、OpenAI客户端和tiktoken编码器均在首次使用时创建（或在warm_up中预热），
+# 避免导入模块时就访问数据库和网络，加快worker启动
 db_pool = None
-try:
-    import mysql.connector.pooling
-    db_pool = mysql.connector.pooling.MySQLConnectionPool(**MYSQL_CONFIG)
-    logger.info("MySQL连接池初始化成功")
-except Exception as e:
-    logger.error(f"MySQL连接池初始化失败: {e}")
-    # 如果连接池初始化失败，后续将使用普通连接
-
-# 初始化OpenAI客户端
-client = OpenAI(
-    api_key=api_key,
-    base_url=api_base
-)
-logger.info(f"Using API base URL: {api_base}")
+_db_pool_initialized = False
+_client = None
+_encoder = None
+_init_lock = threading.Lock()
+
+# 连接池耗尽时等待空闲连接的最长时间（秒），以及连接被占用多久视为疑似泄漏
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_LEAK_THRESHOLD = float(os.getenv("DB_LEAK_THRESHOLD", "30"))
+
+class PoolTimeoutError(mysql.connector.errors.PoolError):
+    """等待空闲数据库连接超时"""
+
+class PooledConnection:
+    """
+    连接池中借出的连接
+    close()可重复调用，只归还一次；支持with语句；
+    调用方忘记close时，对象被回收时交给连接池回收并记录泄漏位置
+    """
+
+    def __init__(self, pool, cnx, owner, key):
+        self._pool = pool
+        self._cnx = cnx
+        self.owner = owner
+        self.key = key
+        self.acquired_at = time.time()
+
+    def __getattr__(self, name):
+        cnx = self.__dict__.get('_cnx')
+        if cnx is None:
+            raise mysql.connector.errors.OperationalError("连接已归还到连接池")
+        return getattr(cnx, name)
+
+    def close(self):
+        cnx, self._cnx = self._cnx, None
+        if cnx is not None:
+            self._pool.release(self.key, cnx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __del__(self):
+        # 垃圾回收可能发生在任意线程持有连接池锁的时候，这里不加锁也不做网络I/O，
+        # 只放入回收队列，由下次get_connection归还
+        cnx = self.__dict__.get('_cnx')
+        if cnx is not None:
+            self._cnx = None
+            self._pool.reclaim(self.key, self.owner, cnx)
+
+class ManagedConnectionPool:
+    """
+    MySQLConnectionPool的包装
+    连接耗尽时阻塞等待（最多timeout秒）而不是立即抛出PoolError，
+    记录每个借出连接的调用位置用于发现泄漏，并统计使用率和等待时间
+    """
+
+    def __init__(self, pool, timeout=DB_POOL_TIMEOUT, leak_threshold=DB_LEAK_THRESHOLD):
+        self._pool = pool
+        self.size = pool.pool_size
+        self.timeout = timeout
+        self.leak_threshold = leak_threshold
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._checked_out = {}
+        self._keys = itertools.count()
+        self._reclaimed = queue.SimpleQueue()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.leaks = 0
+        self.max_in_use = 0
+
+    def get_connection(self):
+        try:
+            caller = sys._getframe(2)
+        except (AttributeError, ValueError):
+            # 调用栈不足两层（如在模块顶层调用）或解释器不支持
+            caller = None
+        owner = f"{caller.f_code.co_name}:{caller.f_lineno}" if caller else 'unknown'
+        
+        self.drain_reclaimed()
+        start_time = time.time()
+        if not self._slots.acquire(blocking=False):
+            if not self._wait_for_slot(start_time + self.timeout):
+                with self._lock:
+                    self.timeouts += 1
+                self.log_stale_checkouts()
+                raise PoolTimeoutError(f"等待数据库连接超时({self.timeout}秒)，连接池大小: {self.size}")
+            waited = time.time() - start_time
+            with self._lock:
+                self.waits += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        
+        try:
+            cnx = self._pool.get_connection()
+        except Exception:
+            self._slots.release()
+            raise
+        conn = PooledConnection(self, cnx, owner, next(self._keys))
+        with self._lock:
+            self._checked_out[conn.key] = (owner, conn.acquired_at)
+            self.checkouts += 1
+            self.max_in_use = max(self.max_in_use, len(self._checked_out))
+        return conn
+
+    def _wait_for_slot(self, deadline):
+        """等待空闲连接，期间定期回收泄漏的连接，避免等待者因泄漏的连接一直等到超时"""
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if self._slots.acquire(timeout=min(remaining, 0.5)):
+                return True
+            self.drain_reclaimed()
+
+    def release(self, key, cnx):
+        with self._lock:
+            self._checked_out.pop(key, None)
+        try:
+            cnx.close()
+        finally:
+            self._slots.release()
+
+    def reclaim(self, key, owner, cnx):
+        """连接未归还就被回收：只入队，可在__del__中安全调用"""
+        self._reclaimed.put((key, owner, cnx))
+
+    def drain_reclaimed(self):
+        """归还回收队列中的连接"""
+        while True:
+            try:
+                key, owner, cnx = self._reclaimed.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self.leaks += 1
+            logger.error(f"数据库连接泄漏：由 {owner} 借出后未归还，已自动回收")
+            try:
+                self.release(key, cnx)
+            except Exception as e:
+                logger.warning(f"回收泄漏的数据库连接失败: {str(e)}")
+
+    def stale_checkouts(self):
+        """被占用超过leak_threshold秒的连接"""
+        now = time.time()
+        with self._lock:
+            return [
+                {'owner': owner, 'held_seconds': round(now - acquired_at, 1)}
+                for owner, acquired_at in self._checked_out.values()
+                if now - acquired_at > self.leak_threshold
+            ]
+
+    def log_stale_checkouts(self):
+        for item in self.stale_checkouts():
+            logger.warning(f"数据库连接疑似泄漏：{item['owner']} 已占用 {item['held_seconds']} 秒")
+
+    def stats(self):
+        with self._lock:
+            in_use = len(self._checked_out)
+            stats = {
+                'size': self.size,
+                'in_use': in_use,
+                'utilization': round(in_use / self.size, 4) if self.size else 0.0,
+                'max_in_use': self.max_in_use,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'avg_wait_ms': round(self.wait_seconds / self.waits * 1000, 2) if self.waits else 0.0,
+                'max_wait_ms': round(self.max_wait_seconds * 1000, 2),
+                'timeouts': self.timeouts,
+                'leaks': self.leaks
+            }
+        stats['stale_checkouts'] = self.stale_checkouts()
+        return stats
+
+def get_db_pool():
+    """获取MySQL连接池，首次调用时创建"""
+    global db_pool, _db_pool_initialized
+    if not _db_pool_initialized:
+        with _init_lock:
+            if not _db_pool_initialized:
+                try:
+                    import mysql.connector.pooling
+                    db_pool = ManagedConnectionPool(mysql.connector.pooling.MySQLConnectionPool(**MYSQL_CONFIG))
+                    logger.info("MySQL连接池初始化成功")
+                except Exception as e:
+                    logger.error(f"MySQL连接池初始化失败: {e}")
+                    # 如果连接池初始化失败，后续将使用普通连接
+                _db_pool_initialized = True
+    ensure_db_schema()
+    return db_pool
+
+# 数据库表结构初始化：首次获取连接池时执行一次（不依赖create_app，app:app等入口同样生效），
+# 失败时间隔DB_SCHEMA_RETRY_INTERVAL秒后再次尝试
+DB_SCHEMA_RETRY_INTERVAL = 60
+_db_schema_lock = threading.RLock()
+_db_schema_ready = False
+_db_schema_running = False
+_db_schema_failed_at = None
+
+def ensure_db_schema():
+    global _db_schema_ready, _db_schema_running, _db_schema_failed_at
+    if _db_schema_ready:
+        return
+    if _db_schema_failed_at is not None and time.time() - _db_schema_failed_at < DB_SCHEMA_RETRY_INTERVAL:
+        return
+    with _db_schema_lock:
+        # init_db内部获取连接时会再次进入这里，同一线程直接返回
+        if _db_schema_ready or _db_schema_running:
+            return
+        _db_schema_running = True
+        try:
+            if init_db():
+                _db_schema_ready = True
+                _db_schema_failed_at = None
+            else:
+                _db_schema_failed_at = time.time()
+        finally:
+            _db_schema_running = False
+
+# OpenAI客户端的HTTP连接池配置
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30"))
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "").lower() in ('1', 'true')
+# 同时进行中的上游请求上限，以及排队等待的最长时间（秒）
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "50"))
+OPENAI_QUEUE_TIMEOUT = float(os.getenv("OPENAI_QUEUE_TIMEOUT", "10"))
+# 预热时提前建立的连接数
+OPENAI_WARMUP_CONNECTIONS = int(os.getenv("OPENAI_WARMUP_CONNECTIONS", "1"))
+
+class UpstreamBusyError(Exception):
+    """等待上游请求名额超时"""
+
+class UpstreamLimiter:
+    """
+    限制同时进行中的上游API请求数量，避免突发流量压垮API网关
+    并统计排队等待时间
+    """
+
+    def __init__(self, max_concurrency, queue_timeout):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self):
+        start_time = time.time()
+        with self._lock:
+            self.waiting += 1
+        ok = self._semaphore.acquire(timeout=self.queue_timeout)
+        wait_time = time.time() - start_time
+        with self._lock:
+            self.waiting -= 1
+            if not ok:
+                self.rejected += 1
+            else:
+                self.in_flight += 1
+                self.acquired += 1
+                self.total_wait += wait_time
+                self.max_wait = max(self.max_wait, wait_time)
+        if not ok:
+            logger.warning(f"等待上游请求名额超时({self.queue_timeout}秒)")
+            raise UpstreamBusyError("上游API繁忙，请稍后重试")
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'acquired': self.acquired,
+                'rejected': self.rejected,
+                'avg_wait_ms': round(self.total_wait / self.acquired * 1000, 2) if self.acquired else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 2)
+            }
+
+upstream_limiter = UpstreamLimiter(OPENAI_MAX_CONCURRENCY, OPENAI_QUEUE_TIMEOUT)
+
+def get_openai_client():
+    """获取OpenAI客户端，首次调用时创建，所有线程共享同一个连接池"""
+    global _client
+    if _client is None:
+        with _init_lock:
+            if _client is None:
+                http2 = OPENAI_HTTP2
+                if http2:
+                    try:
+                        import h2  # noqa: F401
+                    except ImportError:
+                        logger.warning("未安装h2，无法启用HTTP/2（pip install httpx[http2]），使用HTTP/1.1")
+                        http2 = False
+                http_client = openai.DefaultHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+                    ),
+                    http2=http2
+                )
+                _client = OpenAI(
+                    api_key=api_key,
+                    base_url=api_base,
+                    http_client=http_client
+                )
+                logger.info(f"Using API base URL: {api_base}")
+    return _client
+
+def warm_up_openai_connections(count=OPENAI_WARMUP_CONNECTIONS):
+    """提前与API网关建立连接（TCP+TLS），避免首批请求承担建连开销"""
+    if count <= 0 or not api_key:
+        return
+    client = get_openai_client().with_options(max_retries=0, timeout=5)
+
+    def open_connection():
+        try:
+            client.models.list()
+        except Exception as e:
+            logger.warning(f"预热上游连接失败: {str(e)}")
+
+    start_time = time.time()
+    threads = [threading.Thread(target=open_connection) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    logger.info(f"已预热 {count} 个上游连接，耗时: {time.time() - start_time:.2f}秒")
+
+# 对话和图片识别使用的模型
+CHAT_MODEL = "gpt-3.5-turbo"
+VISION_MODEL = "gpt-4o"
 
 # 设置最大token数量
 MAX_TOKENS = 8192  # 系统总限制
 USER_MAX_TOKENS = 1024  # 每个用户的限制
 MAX_RESPONSE_TOKENS = 500
+# 发送给模型的上下文token预算，超出时只保留最近的消息
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", str(MAX_TOKENS - MAX_RESPONSE_TOKENS)))
+# 对话格式的token开销（gpt-3.5-turbo/gpt-4系列）：每条消息3个，回复引导3个
+TOKENS_PER_MESSAGE = 3
+REPLY_PRIMING_TOKENS = 3
+
+# 对话压缩（默认关闭）：会话超过阈值后在后台把较早的消息总结为摘要，
+# 之后的请求以摘要加最近消息作为上下文，会话不必因token超限而重新开始
+COMPACTION_ENABLED = os.getenv("COMPACTION_ENABLED", "").lower() in ('1', 'true')
+COMPACTION_TRIGGER_TOKENS = int(os.getenv("COMPACTION_TRIGGER_TOKENS", str(int(USER_MAX_TOKENS * 0.6))))
+COMPACTION_KEEP_RECENT = int(os.getenv("COMPACTION_KEEP_RECENT", "6"))  # 保留原文的最近消息条数
+COMPACTION_SUMMARY_MAX_TOKENS = int(os.getenv("COMPACTION_SUMMARY_MAX_TOKENS", "300"))
+
+# 聊天历史分页：列表每页条数、对话内容每次加载的消息条数
+CHAT_HISTORY_PAGE_SIZE = 20
+CHAT_HISTORY_MAX_PAGE_SIZE = 100
+CHAT_MESSAGE_WINDOW = 50
+CHAT_MESSAGE_MAX_WINDOW = 500
+
+# 消息内容存储格式：超过MESSAGE_COMPRESS_MIN_BYTES的内容压缩后存入content_blob列
+# 可选 zlib / zstd（需安装zstandard）/ none，读取时按content_format自动识别
+MESSAGE_COMPRESSION = os.getenv("MESSAGE_COMPRESSION", "zlib").lower()
+MESSAGE_COMPRESS_MIN_BYTES = int(os.getenv("MESSAGE_COMPRESS_MIN_BYTES", "512"))
+if MESSAGE_COMPRESSION == 'zstd' and zstandard is None:
+    logger.warning("未安装zstandard，消息压缩改用zlib（pip install zstandard）")
+    MESSAGE_COMPRESSION = 'zlib'
+
+# 密码哈希方法和参数，格式与werkzeug一致，例如 pbkdf2:sha256:600000 或 scrypt:32768:8:1
+# 参数调整后，用户下次用密码登录成功时自动按新参数重新哈希
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "pbkdf2:sha256")
 
 # 验证码有效期（秒）
 VERIFICATION_CODE_EXPIRE = 300  # 5分钟有效期
@@ -84,23 +538,218 @@ VERIFICATION_CODE_EXPIRE = 300  # 5分钟有效期
 UPLOAD_FOLDER = 'static/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB 限制
+# 分块写入上传文件时每次读取的字节数
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 # 确保上传目录存在
 upload_dir = os.path.join(app.root_path, UPLOAD_FOLDER)
 if not os.path.exists(upload_dir):
     os.makedirs(upload_dir)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# 请求体上限：文件大小加上表单字段等开销，超出时Werkzeug在读取请求体前直接返回413
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + 1024 * 1024
+
+# tiktoken的BPE文件缓存目录，随项目一同部署即可离线加载编码器
+# 可通过 `flask --app app warm-tiktoken-cache` 预先下载
+TIKTOKEN_CACHE_DIR = os.getenv("TIKTOKEN_CACHE_DIR", os.path.join(app.root_path, 'tiktoken_cache'))
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+
+# 编码器加载失败（如离线且没有本地缓存）后，间隔多久再尝试加载（秒）；期间直接失败，不再阻塞请求
+ENCODER_RETRY_INTERVAL = 300
+_encoder_lock = threading.Lock()
+_encoder_failed_at = None
 
-# 初始化tiktoken编码器
-encoder = tiktoken.encoding_for_model("gpt-4")
+def get_encoder():
+    """获取tiktoken编码器，首次调用时从本地缓存目录加载"""
+    global _encoder, _encoder_failed_at
+    if _encoder is None:
+        with _encoder_lock:
+            if _encoder is None:
+                if _encoder_failed_at is not None and time.time() - _encoder_failed_at < ENCODER_RETRY_INTERVAL:
+                    raise RuntimeError("tiktoken编码器不可用")
+                start_time = time.time()
+                try:
+                    _encoder = tiktoken.encoding_for_model("gpt-4")
+                except Exception as e:
+                    _encoder_failed_at = time.time()
+                    logger.error(f"tiktoken编码器加载失败，{ENCODER_RETRY_INTERVAL}秒内不再尝试: {str(e)}")
+                    raise
+                _encoder_failed_at = None
+                logger.info(f"tiktoken编码器加载完成，耗时: {time.time() - start_time:.2f}秒")
+    return _encoder
+
+# token计数缓存的内存预算（MB）
+TOKEN_CACHE_MAX_MB = float(os.getenv("TOKEN_CACHE_MAX_MB", "16"))
+
+class TokenCountCache:
+    """
+    token计数的LRU缓存
+    以文本内容的哈希作为键，只保存token数量，按内存预算限制条目数
+    """
+    # 单个条目的估算内存占用（16字节摘要 + int + OrderedDict节点开销）
+    ENTRY_SIZE = 160
+
+    def __init__(self, max_bytes):
+        self.max_entries = max(int(max_bytes // self.ENTRY_SIZE), 0)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._data),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+token_cache = TokenCountCache(TOKEN_CACHE_MAX_MB * 1024 * 1024)
+
+# 回复缓存：相同的对话内容直接返回缓存的回复（默认关闭）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "").lower() in ('1', 'true')
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", "32"))
+# 设置目录后启用磁盘缓存，多个worker之间共享
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")
+RESPONSE_CACHE_DISK_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_ENTRIES", "10000"))
+
+class ResponseCache:
+    """
+    AI回复的精确匹配缓存
+    以模型、max_tokens和标准化后的消息内容为键，内存中按LRU淘汰并限制总字节数，
+    可选的磁盘缓存按条目数限制，两者都有过期时间
+    """
+
+    def __init__(self, enabled, ttl, max_bytes, cache_dir='', disk_max_entries=0):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        if enabled and cache_dir:
+            self._disk = FileSystemCache(cache_dir, threshold=disk_max_entries, default_timeout=ttl)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model, max_tokens, messages):
+        normalized = [
+            {'role': msg['role'], 'content': msg['content'].strip() if isinstance(msg['content'], str) else msg['content']}
+            for msg in messages
+        ]
+        payload = json.dumps({'model': model, 'max_tokens': max_tokens, 'messages': normalized},
+                             ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+        if self._disk is not None:
+            value = self._disk.get(key)
+            if value is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._put_memory(key, value, now)
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._put_memory(key, value, time.time())
+        if self._disk is not None:
+            self._disk.set(key, value)
+
+    def _put_memory(self, key, value, now):
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (now + self.ttl, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, value = self._data.pop(key)
+        self._bytes -= len(value.encode('utf-8'))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0
+            }
+
+response_cache = ResponseCache(RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_MB * 1024 * 1024,
+                               RESPONSE_CACHE_DIR, RESPONSE_CACHE_DISK_MAX_ENTRIES)
 
 # MySQL数据库连接函数
 def get_db_connection():
     """获取数据库连接，优先从连接池获取"""
     try:
-        if db_pool:
+        pool = get_db_pool()
+        if pool:
             # 从连接池获取连接
-            connection = db_pool.get_connection()
+            connection = pool.get_connection()
             return connection
         else:
             # 如果连接池不可用，使用普通连接
@@ -108,7 +757,9 @@ def get_db_connection():
                 host=MYSQL_CONFIG['host'],
                 user=MYSQL_CONFIG['user'],
                 password=MYSQL_CONFIG['password'],
-                database=MYSQL_CONFIG['database']
+                database=MYSQL_CONFIG['database'],
+                client_flags=MYSQL_CONFIG['client_flags'],
+                use_pure=ASYNC_MODE
             )
             return connection
     except mysql.connector.Error as err:
@@ -171,6 +822,102 @@ def init_db():
             cursor.execute("ALTER TABLE chat_histories ADD COLUMN session_data LONGTEXT AFTER title")
             logger.info("已向chat_histories表添加session_data列")
         
+        # 对话压缩摘要：summary_upto_seq之前的消息已被总结进summary
+        cursor.execute("SHOW COLUMNS FROM chat_histories LIKE 'summary'")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE chat_histories ADD COLUMN summary TEXT NULL AFTER session_data, "
+                           "ADD COLUMN summary_upto_seq INT NOT NULL DEFAULT 0 AFTER summary")
+            logger.info("已向chat_histories表添加summary列")
+        
+        # scrypt哈希长度超过128，放宽password_hash列
+        cursor.execute("SHOW COLUMNS FROM users LIKE 'password_hash'")
+        column = cursor.fetchone()
+        column_type = column[1].decode() if column and isinstance(column[1], bytes) else (column[1] if column else '')
+        if column_type.lower() == 'varchar(128)':
+            cursor.execute("ALTER TABLE users MODIFY password_hash VARCHAR(255) NOT NULL")
+            logger.info("已将users.password_hash列扩展为VARCHAR(255)")
+        
+        # 用户是否使用回复缓存
+        cursor.execute("SHOW COLUMNS FROM users LIKE 'response_cache_enabled'")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE users ADD COLUMN response_cache_enabled TINYINT(1) NOT NULL DEFAULT 1")
+            logger.info("已向users表添加response_cache_enabled列")
+        
+        # 聊天历史列表按(updated_at, id)分页所需的索引
+        cursor.execute("SHOW INDEX FROM chat_histories WHERE Key_name = 'user_updated_idx'")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE chat_histories ADD INDEX user_updated_idx (user_id, updated_at, id)")
+            logger.info("已向chat_histories表添加user_updated_idx索引")
+        
+        # 创建聊天消息表（每条消息一行，只追加）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_messages (
+                id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                chat_history_id INT NOT NULL,
+                user_id INT NOT NULL,
+                seq INT NOT NULL,
+                role VARCHAR(20) NOT NULL,
+                content LONGTEXT NOT NULL,
+                content_blob LONGBLOB NULL,
+                content_format VARCHAR(10) NOT NULL DEFAULT 'text',
+                token_count INT NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE KEY chat_seq_idx (chat_history_id, seq),
+                FOREIGN KEY (chat_history_id) REFERENCES chat_histories(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        # 压缩后的消息内容保存在content_blob中
+        cursor.execute("SHOW COLUMNS FROM chat_messages LIKE 'content_blob'")
+        if not cursor.fetchone():
+            cursor.execute("ALTER TABLE chat_messages ADD COLUMN content_blob LONGBLOB NULL AFTER content")
+            logger.info("已向chat_messages表添加content_blob列")
+        
+        # 创建用户token用量表（按天聚合）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_token_usage (
+                user_id INT NOT NULL,
+                usage_date DATE NOT NULL,
+                prompt_tokens BIGINT NOT NULL DEFAULT 0,
+                completion_tokens BIGINT NOT NULL DEFAULT 0,
+                requests INT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, usage_date),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        # 创建上传文件引用表（文件按内容哈希存储，每个用户一条引用）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_uploads (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                content_hash CHAR(64) NOT NULL,
+                stored_name VARCHAR(100) NOT NULL,
+                original_name VARCHAR(255),
+                file_size INT NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE KEY user_hash_idx (user_id, content_hash),
+                INDEX content_hash_idx (content_hash),
+                FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            )
+        ''')
+        
+        # 创建对话图片索引表，记录图片被哪些对话使用，供上传文件清理判断
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_uploads (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                chat_history_id INT NOT NULL,
+                user_id INT NOT NULL,
+                content_hash CHAR(64) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE KEY chat_hash_idx (chat_history_id, content_hash),
+                INDEX content_hash_idx (content_hash),
+                FOREIGN KEY (chat_history_id) REFERENCES chat_histories(id) ON DELETE CASCADE
+            )
+        ''')
+        
         conn.commit()
         conn.close()
         
@@ -180,6 +927,199 @@ def init_db():
         logger.error(f"数据库初始化失败: {str(e)}")
         return False
 
+# 用户token用量：内存中累计，定期批量写入数据库
+USER_DAILY_TOKEN_QUOTA = int(os.getenv("USER_DAILY_TOKEN_QUOTA", "0"))  # 0表示不限制
+USER_MONTHLY_TOKEN_QUOTA = int(os.getenv("USER_MONTHLY_TOKEN_QUOTA", "0"))  # 0表示不限制
+USAGE_FLUSH_INTERVAL = int(os.getenv("USAGE_FLUSH_INTERVAL", "10"))  # 秒
+# 多个worker各自累计，定期从数据库重新加载其他worker已写入的用量
+USAGE_REFRESH_INTERVAL = int(os.getenv("USAGE_REFRESH_INTERVAL", "60"))  # 秒
+
+class UsageLedger:
+    """
+    按用户、按天记录token用量
+    每次请求只更新内存计数，额度检查也直接读取内存；
+    增量按(用户, 日期)聚合后由后台线程批量写入user_token_usage表
+    """
+
+    def __init__(self, daily_quota, monthly_quota, refresh_interval):
+        self.daily_quota = daily_quota
+        self.monthly_quota = monthly_quota
+        self.refresh_interval = refresh_interval
+        # (用户ID, 日期) -> [prompt_tokens, completion_tokens, requests]，尚未写入数据库的增量
+        self._pending = {}
+        # 用户ID -> {'day', 'month', 'daily', 'monthly', 'loaded_at'}，数据库基线加上本进程之后的增量
+        self._totals = {}
+        self._lock = threading.Lock()
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+
+    def _pending_since(self, user_id, day):
+        daily = monthly = 0
+        for (pending_user, pending_day), (prompt_tokens, completion_tokens, _) in self._pending.items():
+            if pending_user != user_id or pending_day.replace(day=1) != day.replace(day=1):
+                continue
+            monthly += prompt_tokens + completion_tokens
+            if pending_day == day:
+                daily += prompt_tokens + completion_tokens
+        return daily, monthly
+
+    def _load(self, user_id, day):
+        """从数据库加载用户当天和当月已写入的用量"""
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COALESCE(SUM(CASE WHEN usage_date = %s THEN prompt_tokens + completion_tokens END), 0),
+                       COALESCE(SUM(prompt_tokens + completion_tokens), 0)
+                FROM user_token_usage
+                WHERE user_id = %s AND usage_date BETWEEN %s AND %s
+            ''', (day, user_id, day.replace(day=1), day))
+            daily, monthly = cursor.fetchone()
+        finally:
+            conn.close()
+        with self._lock:
+            pending_daily, pending_monthly = self._pending_since(user_id, day)
+            totals = {
+                'day': day,
+                'daily': int(daily) + pending_daily,
+                'monthly': int(monthly) + pending_monthly,
+                'loaded_at': time.time()
+            }
+            self._totals[user_id] = totals
+            return dict(totals)
+
+    def usage(self, user_id):
+        """获取用户当天和当月的用量，过期或跨天时重新从数据库加载"""
+        day = datetime.date.today()
+        with self._lock:
+            totals = self._totals.get(user_id)
+            if totals and totals['day'] == day and time.time() - totals['loaded_at'] < self.refresh_interval:
+                return dict(totals)
+        try:
+            return self._load(user_id, day)
+        except Exception as e:
+            logger.error(f"加载用户token用量失败 (用户ID: {user_id}): {str(e)}")
+            # 数据库不可用时沿用内存中的数据
+            with self._lock:
+                totals = self._totals.get(user_id)
+                if totals and totals['day'] == day:
+                    return dict(totals)
+            return {'day': day, 'daily': 0, 'monthly': 0, 'loaded_at': 0}
+
+    def check(self, user_id):
+        """
+        检查用户是否还有额度
+        :return: (是否允许, 提示信息)
+        """
+        if self.daily_quota <= 0 and self.monthly_quota <= 0:
+            return True, None
+        totals = self.usage(user_id)
+        if self.daily_quota > 0 and totals['daily'] >= self.daily_quota:
+            return False, f"今日token用量已达上限({self.daily_quota})，请明天再试"
+        if self.monthly_quota > 0 and totals['monthly'] >= self.monthly_quota:
+            return False, f"本月token用量已达上限({self.monthly_quota})"
+        return True, None
+
+    def record(self, user_id, prompt_tokens, completion_tokens):
+        """记录一次请求的用量，只更新内存；写入线程未启动时随之启动"""
+        day = datetime.date.today()
+        tokens = prompt_tokens + completion_tokens
+        with self._lock:
+            entry = self._pending.setdefault((user_id, day), [0, 0, 0])
+            entry[0] += prompt_tokens
+            entry[1] += completion_tokens
+            entry[2] += 1
+            totals = self._totals.get(user_id)
+            if totals and totals['day'] == day:
+                totals['daily'] += tokens
+                totals['monthly'] += tokens
+        # 未通过create_app启动（如 flask --app app run 或 app:app）时，首次记录用量时启动写入线程
+        if not _usage_flusher_started:
+            start_usage_flusher()
+
+    def flush(self):
+        """将累计的增量批量写入数据库，失败时放回等待下次写入"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        rows = [(user_id, day, values[0], values[1], values[2]) for (user_id, day), values in pending.items()]
+        try:
+            conn = get_db_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT INTO user_token_usage (user_id, usage_date, prompt_tokens, completion_tokens, requests)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        prompt_tokens = prompt_tokens + VALUES(prompt_tokens),
+                        completion_tokens = completion_tokens + VALUES(completion_tokens),
+                        requests = requests + VALUES(requests)
+                ''', rows)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception:
+            with self._lock:
+                for key, values in pending.items():
+                    entry = self._pending.setdefault(key, [0, 0, 0])
+                    for i in range(3):
+                        entry[i] += values[i]
+                self.flush_errors += 1
+            raise
+        with self._lock:
+            self.flushes += 1
+            self.flushed_rows += len(rows)
+        return len(rows)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_rows': len(self._pending),
+                'tracked_users': len(self._totals),
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'flush_errors': self.flush_errors,
+                'daily_quota': self.daily_quota,
+                'monthly_quota': self.monthly_quota
+            }
+
+usage_ledger = UsageLedger(USER_DAILY_TOKEN_QUOTA, USER_MONTHLY_TOKEN_QUOTA, USAGE_REFRESH_INTERVAL)
+_usage_flusher_started = False
+
+def flush_usage_ledger():
+    try:
+        rows = usage_ledger.flush()
+        if rows:
+            logger.debug(f"已写入 {rows} 条token用量")
+    except Exception as e:
+        logger.error(f"写入token用量失败: {str(e)}")
+
+def record_response_usage(user_id, response, estimated_prompt_tokens, answer):
+    """记录一次非流式调用的用量，上游未返回usage时按本地计算"""
+    if response.usage:
+        usage_ledger.record(user_id, response.usage.prompt_tokens, response.usage.completion_tokens)
+    else:
+        usage_ledger.record(user_id, estimated_prompt_tokens, count_tokens(answer))
+
+def start_usage_flusher(interval=USAGE_FLUSH_INTERVAL):
+    """启动后台线程定期写入token用量，进程退出时再写入一次"""
+    global _usage_flusher_started
+    with _init_lock:
+        if _usage_flusher_started:
+            return
+        _usage_flusher_started = True
+
+    def run():
+        while True:
+            time.sleep(interval)
+            flush_usage_ledger()
+
+    threading.Thread(target=run, name='usage-flusher', daemon=True).start()
+    atexit.register(flush_usage_ledger)
+    logger.info(f"token用量写入线程已启动，间隔: {interval}秒")
+
 # AI聊天相关函数
 def count_tokens(text):
     """计算文本的token数量"""
@@ -187,12 +1127,56 @@ def count_tokens(text):
         # 确保text是字符串
         if not isinstance(text, str):
             text = json.dumps(text)
-        tokens = encoder.encode(text)
-        return len(tokens)
+        key = token_cache.make_key(text)
+        cached = token_cache.get(key)
+        if cached is not None:
+            return cached
+        token_total = len(get_encoder().encode(text))
+        token_cache.put(key, token_total)
+        return token_total
     except Exception as e:
         logger.error(f"Error counting tokens: {str(e)}")
         return 0
 
+def message_tokens(msg):
+    """
+    获取单条消息的token数量
+    token数在消息首次计算时写入msg['tokens']，之后直接复用，避免重复编码
+    """
+    if 'tokens' not in msg:
+        content = msg.get('content')
+        if isinstance(content, list):
+            # 图像消息只统计文本部分
+            msg['tokens'] = sum(count_tokens(part.get('text', '')) for part in content
+                                if isinstance(part, dict) and part.get('type') == 'text')
+        elif content:
+            msg['tokens'] = count_tokens(content)
+        else:
+            msg['tokens'] = 0
+    return msg['tokens']
+
+def new_message(role, content):
+    """创建消息并记录其token数量"""
+    msg = {"role": role, "content": content}
+    message_tokens(msg)
+    return msg
+
+def summarize_token_count(messages):
+    """根据每条消息缓存的token数汇总会话token使用情况"""
+    user_tokens = 0
+    assistant_tokens = 0
+    total = 0
+    for msg in messages:
+        if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
+            continue
+        tokens = message_tokens(msg)
+        if msg['role'] == 'user':
+            user_tokens += tokens
+        elif msg['role'] == 'assistant':
+            assistant_tokens += tokens
+        total += tokens
+    return {'user_tokens': user_tokens, 'assistant_tokens': assistant_tokens, 'total': total}
+
 def sanitize_messages(messages):
     """清理和标准化消息格式"""
     sanitized = []
@@ -204,46 +1188,102 @@ def sanitize_messages(messages):
             })
     return sanitized
 
-def manage_token_limit(messages):
-    """管理消息的token数量，确保不超过限制"""
+def chat_message_tokens(msg):
+    """按对话格式计算单条消息占用的token：内容token加上每条消息的格式开销"""
+    tokens = TOKENS_PER_MESSAGE + message_tokens(msg)
+    if msg.get('name'):
+        tokens += 1
+    return tokens
+
+def manage_token_limit(messages, budget=None):
+    """
+    管理消息的token数量，确保不超过限制
+    :return: (是否在预算内, 按对话格式计算的prompt token数)
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
     try:
-        messages = sanitize_messages(messages)
-        messages_json = json.dumps(messages)
-        current_tokens = count_tokens(messages_json)
-        return current_tokens <= (MAX_TOKENS - MAX_RESPONSE_TOKENS), current_tokens
+        current_tokens = REPLY_PRIMING_TOKENS + sum(
+            chat_message_tokens(msg) for msg in messages
+            if isinstance(msg, dict) and 'role' in msg and 'content' in msg)
+        return current_tokens <= budget, current_tokens
     except Exception as e:
         logger.error(f"Error managing token limit: {str(e)}")
         return True, 0
 
-def get_gpt_response(messages):
-    """获取GPT回复"""
+def build_context_messages(messages, budget=None):
+    """
+    构建发送给模型的上下文：保留全部system消息，从最新的消息往前选取，直到用完token预算
+    最新一条消息即使超出预算也会保留
+    :return: (标准化后的消息列表, prompt token数)
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    messages = [msg for msg in messages if isinstance(msg, dict) and 'role' in msg and 'content' in msg]
+    fits, prompt_tokens = manage_token_limit(messages, budget)
+    if fits:
+        return sanitize_messages(messages), prompt_tokens
+    
+    used = REPLY_PRIMING_TOKENS
+    keep = set()
+    for index, msg in enumerate(messages):
+        if msg['role'] == 'system':
+            keep.add(index)
+            used += chat_message_tokens(msg)
+    kept_recent = 0
+    for index in range(len(messages) - 1, -1, -1):
+        if index in keep:
+            continue
+        cost = chat_message_tokens(messages[index])
+        if used + cost > budget and kept_recent:
+            break
+        keep.add(index)
+        used += cost
+        kept_recent += 1
+    
+    selected = [messages[index] for index in sorted(keep)]
+    logger.info(f"上下文超出token预算({prompt_tokens}>{budget})，保留最近 {len(selected)}/{len(messages)} 条消息，"
+                f"prompt token数: {used}")
+    return sanitize_messages(selected), used
+
+def get_gpt_response(messages, use_cache=True, user_id=None):
+    """
+    获取GPT回复
+    :param use_cache: 是否允许使用回复缓存（用户可关闭）
+    :param user_id: 用户ID，提供时将上游实际用量记入用户token用量（命中缓存不计）
+    """
     try:
-        # 标准化消息格式
-        messages = sanitize_messages(messages)
+        # 计算用户消息和助手消息（历史对话）的token数
+        token_count = summarize_token_count(messages)
+        user_tokens = token_count['user_tokens']
+        assistant_tokens_history = token_count['assistant_tokens']
+        
+        # 按token预算选取上下文并标准化消息格式
+        messages, prompt_tokens = build_context_messages(messages)
         
         # 确保消息列表不为空
         if not messages:
             messages = [{"role": "system", "content": "你好，我是天衍智能助手，请问有什么可以帮助你的？"}]
         
-        # 计算用户消息token数
-        user_messages = [msg for msg in messages if msg['role'] == 'user']
-        user_tokens = sum(count_tokens(msg['content']) for msg in user_messages)
-        
-        # 计算助手消息token数（历史对话）
-        assistant_messages = [msg for msg in messages if msg['role'] == 'assistant']
-        assistant_tokens_history = sum(count_tokens(msg['content']) for msg in assistant_messages)
+        # 查询回复缓存
+        cache_key = None
+        if use_cache and response_cache.enabled:
+            cache_key = response_cache.make_key(CHAT_MODEL, MAX_RESPONSE_TOKENS, messages)
+            answer = response_cache.get(cache_key)
+            if answer is not None:
+                logger.info("命中回复缓存")
+                return answer, user_tokens, assistant_tokens_history + count_tokens(answer)
         
         logger.info("开始调用GPT API")
-        logger.debug(f"发送的消息数量: {len(messages)}")
+        logger.debug(f"发送的消息数量: {len(messages)}，prompt token数: {prompt_tokens}")
         
         start_time = time.time()
         try:
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                max_tokens=MAX_RESPONSE_TOKENS,
-                timeout=30  # 添加30秒超时
-            )
+            with upstream_limiter:
+                response = get_openai_client().chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=messages,
+                    max_tokens=MAX_RESPONSE_TOKENS,
+                    timeout=30  # 添加30秒超时
+                )
         except Exception as api_error:
             logger.error(f"GPT API调用失败: {str(api_error)}")
             # 检查是否是网络或超时错误
@@ -260,6 +1300,10 @@ def get_gpt_response(messages):
         
         # 获取助手回复
         answer = response.choices[0].message.content.strip()
+        if cache_key:
+            response_cache.put(cache_key, answer)
+        if user_id:
+            record_response_usage(user_id, response, prompt_tokens, answer)
         # 计算新的助手回复token数
         new_assistant_tokens = count_tokens(answer)
         total_assistant_tokens = assistant_tokens_history + new_assistant_tokens
@@ -273,17 +1317,396 @@ def get_gpt_response(messages):
         error_msg = f"处理请求时发生错误: {str(e)}"
         return error_msg, 0, count_tokens(error_msg)
 
+def stream_gpt_response(messages, use_cache=True, user_id=None):
+    """
+    以流式方式获取GPT回复
+    :param messages: 消息数组
+    :param use_cache: 是否允许使用回复缓存（用户可关闭）
+    :param user_id: 用户ID，提供时将上游实际用量记入用户token用量
+    :return: 生成器，依次产出 ('delta', 文本片段)，最后产出 ('usage', token用量字典)
+    """
+    messages, prompt_tokens = build_context_messages(messages)
+    if not messages:
+        messages = [{"role": "system", "content": "你好，我是天衍智能助手，请问有什么可以帮助你的？"}]
+    
+    # 命中回复缓存时一次性返回完整回复
+    cache_key = None
+    if use_cache and response_cache.enabled:
+        cache_key = response_cache.make_key(CHAT_MODEL, MAX_RESPONSE_TOKENS, messages)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("命中回复缓存（流式）")
+            yield 'delta', cached
+            completion_tokens = count_tokens(cached)
+            yield 'usage', {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens
+            }
+            return
+    
+    logger.info("开始调用GPT API（流式）")
+    logger.debug(f"发送的消息数量: {len(messages)}，prompt token数: {prompt_tokens}")
+    
+    start_time = time.time()
+    first_token_time = None
+    answer_parts = []
+    usage = None
+    try:
+        # 流式响应期间一直占用上游请求名额
+        with upstream_limiter:
+            stream = get_openai_client().chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                max_tokens=MAX_RESPONSE_TOKENS,
+                timeout=30,
+                stream=True,
+                stream_options={"include_usage": True}  # 在最后一个数据块中返回token用量
+            )
+            for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                        logger.info(f"GPT API首个token耗时: {first_token_time - start_time:.2f}秒")
+                    answer_parts.append(delta)
+                    yield 'delta', delta
+            # 完整接收后才写入缓存
+            if cache_key and answer_parts:
+                response_cache.put(cache_key, ''.join(answer_parts).strip())
+    except Exception as api_error:
+        logger.error(f"GPT API流式调用失败: {str(api_error)}")
+        if "timeout" in str(api_error).lower():
+            error_msg = "API请求超时，请稍后重试"
+        elif "connection" in str(api_error).lower():
+            error_msg = "连接API服务器失败，请检查网络"
+        else:
+            error_msg = f"API调用失败: {str(api_error)}"
+        # 与非流式接口保持一致：错误信息作为回复内容返回
+        yield 'delta', error_msg if not answer_parts else f"\n\n{error_msg}"
+    
+    logger.info(f"GPT API流式调用完成，耗时: {time.time() - start_time:.2f}秒")
+    
+    if usage:
+        if user_id:
+            usage_ledger.record(user_id, usage.prompt_tokens, usage.completion_tokens)
+        yield 'usage', {
+            'prompt_tokens': usage.prompt_tokens,
+            'completion_tokens': usage.completion_tokens,
+            'total_tokens': usage.total_tokens
+        }
+    else:
+        # 部分API网关不支持include_usage，退回本地计算
+        completion_tokens = count_tokens(''.join(answer_parts))
+        if user_id and answer_parts:
+            usage_ledger.record(user_id, prompt_tokens, completion_tokens)
+        yield 'usage', {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+
+# 对话压缩：将较早的消息总结为摘要
+COMPACTION_PROMPT = (
+    "请将以下对话总结为简洁的摘要，供后续对话作为上下文使用。"
+    "保留关键事实、用户的偏好和要求、已经得出的结论以及尚未解决的问题，不要添加对话中没有的内容。"
+)
+
+_compaction_executor = None
+_compaction_pending = set()
+_compaction_lock = threading.Lock()
+
+def summary_message(summary):
+    """将摘要转换为放在上下文开头的system消息"""
+    return new_message("system", f"以下是之前对话的摘要：\n{summary['content']}")
+
+def build_prompt_messages(messages, summary=None):
+    """有摘要时以摘要代替已被总结的消息，其余消息保持原样"""
+    if not summary:
+        return messages
+    return [summary_message(summary)] + messages[summary['upto_seq']:]
+
+def effective_token_count(messages, summary=None):
+    """实际发送给模型的上下文token数（摘要加未总结的消息）"""
+    return summarize_token_count(build_prompt_messages(messages, summary))['total']
+
+def message_text(msg):
+    """取出消息中的文本，图片消息只保留文字部分"""
+    content = msg.get('content')
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') for part in content
+                        if isinstance(part, dict) and part.get('type') == 'text')
+    return content or ''
+
+def summarize_messages(previous_summary, messages):
+    """调用模型把已有摘要和新的消息合并为新的摘要"""
+    role_names = {'user': '用户', 'assistant': '助手', 'system': '系统'}
+    lines = []
+    if previous_summary:
+        lines.append(f"已有摘要：\n{previous_summary}\n\n新的对话：")
+    for msg in messages:
+        lines.append(f"{role_names.get(msg['role'], msg['role'])}：{message_text(msg)}")
+    with upstream_limiter:
+        response = get_openai_client().chat.completions.create(
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": COMPACTION_PROMPT},
+                {"role": "user", "content": "\n".join(lines)}
+            ],
+            max_tokens=COMPACTION_SUMMARY_MAX_TOKENS,
+            timeout=60
+        )
+    return response.choices[0].message.content.strip()
+
+def compact_chat_history(chat_history_id):
+    """
+    压缩一个对话：把摘要之后、最近COMPACTION_KEEP_RECENT条之前的消息合并进摘要
+    以summary_upto_seq做乐观锁，避免并发压缩互相覆盖
+    :return: 是否更新了摘要
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT summary, summary_upto_seq FROM chat_histories WHERE id = %s", (chat_history_id,))
+        row = cursor.fetchone()
+        if not row:
+            return False
+        messages = fetch_chat_messages(cursor, chat_history_id)
+    finally:
+        conn.close()
+    
+    upto_seq = row['summary_upto_seq']
+    new_upto_seq = len(messages) - COMPACTION_KEEP_RECENT
+    if new_upto_seq <= upto_seq:
+        return False
+    
+    start_time = time.time()
+    summary = summarize_messages(row['summary'], messages[upto_seq:new_upto_seq])
+    
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE chat_histories SET summary = %s, summary_upto_seq = %s, updated_at = updated_at
+            WHERE id = %s AND summary_upto_seq = %s
+        ''', (summary, new_upto_seq, chat_history_id, upto_seq))
+        updated = cursor.rowcount > 0
+        conn.commit()
+    finally:
+        conn.close()
+    logger.info(f"对话压缩完成 (聊天历史ID: {chat_history_id})，已总结 {new_upto_seq} 条消息，"
+                f"摘要token数: {count_tokens(summary)}，耗时: {time.time() - start_time:.2f}秒")
+    return updated
+
+def schedule_compaction(chat_history_id):
+    """在后台线程中压缩对话，同一对话同时只有一个任务"""
+    global _compaction_executor
+    with _compaction_lock:
+        if chat_history_id in _compaction_pending:
+            return
+        _compaction_pending.add(chat_history_id)
+        if _compaction_executor is None:
+            _compaction_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='compaction')
+    
+    def run():
+        try:
+            compact_chat_history(chat_history_id)
+        except Exception as e:
+            logger.error(f"对话压缩失败 (聊天历史ID: {chat_history_id}): {str(e)}")
+        finally:
+            with _compaction_lock:
+                _compaction_pending.discard(chat_history_id)
+    
+    _compaction_executor.submit(run)
+
+# 从各种格式的会话数据中提取消息数组
+def extract_session_messages(user_id, session_data):
+    """
+    提取消息数组
+    :param session_data: 消息数组、包含messages_{user_id}的字典、{'messages': [...]}格式的字典或JSON字符串
+    :return: 消息数组
+    """
+    if not session_data:
+        return []
+    if isinstance(session_data, str):
+        try:
+            session_data = json.loads(session_data)
+        except json.JSONDecodeError:
+            logger.error("解析会话数据JSON失败")
+            return []
+    if isinstance(session_data, list):
+        return session_data
+    if isinstance(session_data, dict):
+        # 如果是旧格式的会话数据，提取消息
+        user_messages_key = f'messages_{user_id}'
+        if user_messages_key in session_data:
+            return session_data[user_messages_key]
+        return session_data.get('messages', [])
+    return []
+
+# 消息内容编解码
+def compress_bytes(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 6)
+
+def decompress_bytes(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("读取zstd压缩的消息需要安装zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError(f"未知的消息压缩格式: {codec}")
+
+def encode_message_content(content, codec=None):
+    """
+    将消息内容编码为存储格式
+    content_format为 text/json，压缩时追加压缩算法，如 text+zlib、json+zstd
+    :param codec: 压缩算法，默认使用MESSAGE_COMPRESSION
+    :return: (content, content_blob, content_format)
+    """
+    if isinstance(content, str):
+        content_format = 'text'
+    else:
+        # 图片消息等结构化内容以紧凑的JSON保存，中文不转义
+        content = json.dumps(content, ensure_ascii=False, separators=(',', ':'))
+        content_format = 'json'
+    codec = codec or MESSAGE_COMPRESSION
+    if codec == 'none':
+        return content, None, content_format
+    data = content.encode('utf-8')
+    if len(data) < MESSAGE_COMPRESS_MIN_BYTES:
+        return content, None, content_format
+    blob = compress_bytes(data, codec)
+    if len(blob) > len(data) * 0.9:
+        # 压缩收益太小时保留原文，便于直接查询
+        return content, None, content_format
+    return '', blob, f"{content_format}+{codec}"
+
+def decode_message_content(content, content_blob, content_format):
+    """按content_format还原消息内容，兼容未压缩的旧数据"""
+    content_format, _, codec = content_format.partition('+')
+    if codec:
+        content = decompress_bytes(bytes(content_blob), codec).decode('utf-8')
+    if content_format == 'json':
+        return json.loads(content)
+    return content
+
+# 追加消息到chat_messages表
+def append_chat_messages(cursor, chat_history_id, user_id, messages, start_seq=0):
+    """
+    将消息逐条追加到chat_messages表（每条消息一行，只插入不更新）
+    :param start_seq: 第一条消息的序号
+    :return: 插入的消息数量
+    """
+    rows = []
+    for offset, msg in enumerate(messages):
+        if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
+            continue
+        content, content_blob, content_format = encode_message_content(msg['content'])
+        rows.append((chat_history_id, user_id, start_seq + offset, msg['role'],
+                     content, content_blob, content_format, message_tokens(msg)))
+    if rows:
+        cursor.executemany(
+            "INSERT INTO chat_messages (chat_history_id, user_id, seq, role, content, content_blob, content_format, token_count) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+            rows
+        )
+    return len(rows)
+
+# 读取chat_messages表中的消息
+def fetch_chat_messages(cursor, chat_history_id):
+    """按顺序读取聊天历史的全部消息"""
+    cursor.execute(
+        "SELECT role, content, content_blob, content_format, token_count FROM chat_messages "
+        "WHERE chat_history_id = %s ORDER BY seq",
+        (chat_history_id,)
+    )
+    return [row_to_message(row) for row in cursor.fetchall()]
+
+def row_to_message(row):
+    """将chat_messages表的一行转换为消息"""
+    content = decode_message_content(row['content'], row['content_blob'], row['content_format'])
+    return {'role': row['role'], 'content': content, 'tokens': row['token_count']}
+
+# 按窗口读取chat_messages表中的消息
+def fetch_chat_message_window(cursor, chat_history_id, limit, before_seq=None):
+    """
+    读取序号小于before_seq的最近limit条消息
+    :return: (按时间顺序排列的消息数组, 窗口中第一条消息的序号, 是否还有更早的消息)
+    """
+    if before_seq is None:
+        cursor.execute(
+            "SELECT seq, role, content, content_blob, content_format, token_count FROM chat_messages "
+            "WHERE chat_history_id = %s ORDER BY seq DESC LIMIT %s",
+            (chat_history_id, limit + 1)
+        )
+    else:
+        cursor.execute(
+            "SELECT seq, role, content, content_blob, content_format, token_count FROM chat_messages "
+            "WHERE chat_history_id = %s AND seq < %s ORDER BY seq DESC LIMIT %s",
+            (chat_history_id, before_seq, limit + 1)
+        )
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    first_seq = rows[0]['seq'] if rows else before_seq
+    return [row_to_message(row) for row in rows], first_seq, has_more
+
+# 两条消息的角色和内容是否相同（忽略tokens等附加字段）
+def same_message(a, b):
+    return (isinstance(a, dict) and isinstance(b, dict)
+            and a.get('role') == b.get('role') and a.get('content') == b.get('content'))
+
+# 找出会话中尚未保存的消息
+def unsaved_chat_messages(cursor, chat_history_id, messages, base_seq):
+    """
+    对比数据库中base_seq之后的消息与会话快照
+    与快照一致的部分视为已保存（例如上次写入已提交但返回失败后的重试）；
+    不一致说明其他请求基于同一历史写入了消息，本轮的消息全部追加在其后
+    :return: 需要追加的消息数组
+    """
+    cursor.execute(
+        "SELECT role, content, content_blob, content_format, token_count FROM chat_messages "
+        "WHERE chat_history_id = %s AND seq >= %s ORDER BY seq",
+        (chat_history_id, base_seq)
+    )
+    stored_tail = [row_to_message(row) for row in cursor.fetchall()]
+    snapshot_tail = messages[base_seq:]
+    matched = 0
+    for stored_msg, msg in zip(stored_tail, snapshot_tail):
+        if not same_message(stored_msg, msg):
+            break
+        matched += 1
+    if matched == len(stored_tail):
+        return snapshot_tail[matched:]
+    logger.warning(f"会话保存冲突：序号{base_seq}之后已有其他请求写入的{len(stored_tail)}条消息，"
+                   f"本轮的{len(snapshot_tail)}条消息追加在其后 (聊天历史ID: {chat_history_id})")
+    return snapshot_tail
+
+class ChatHistoryNotFoundError(Exception):
+    """聊天历史不存在或不属于该用户"""
+
 # 保存用户会话历史到数据库
-def save_user_session(user_id, session_data, chat_history_id=None):
+def store_chat_messages(user_id, session_data, chat_history_id=None, base_seq=None):
     """
-    保存用户会话数据到数据库
+    保存用户会话数据到数据库，失败时抛出异常（写后队列据此判断是否重试）
+    只追加数据库中尚未保存的消息，不会重写整个会话
     :param user_id: 用户ID
     :param session_data: 消息数组或包含消息数组的会话数据
     :param chat_history_id: 聊天历史记录ID（可选）
-    :return: 保存是否成功
+    :param base_seq: 本轮对话开始时加载的消息数（可选）。数据库中该位置之后已有其他请求写入的消息时，
+                     本轮的消息追加在其后并记录冲突，而不是按数量判断为已保存
+    :return: 聊天历史ID
     """
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
 
         # 如果没有提供聊天历史ID，查找用户的默认会话
@@ -305,40 +1728,51 @@ def save_user_session(user_id, session_data, chat_history_id=None):
                 )
                 chat_history_id = cursor.lastrowid
 
-        # 确保session_data是一个包含消息数组的字典，或直接是消息数组
-        messages = session_data
-        if isinstance(session_data, dict):
-            # 如果是旧格式的会话数据，提取消息
-            user_messages_key = f'messages_{user_id}'
-            if user_messages_key in session_data:
-                messages = session_data[user_messages_key]
+        messages = extract_session_messages(user_id, session_data)
         
-        # 序列化消息数据
-        session_json = json.dumps({
-            'messages': messages,
-            'token_count': {
-                'user_tokens': sum(count_tokens(msg['content']) for msg in messages if msg['role'] == 'user' and isinstance(msg['content'], str)),
-                'assistant_tokens': sum(count_tokens(msg['content']) for msg in messages if msg['role'] == 'assistant' and isinstance(msg['content'], str)),
-                'total': sum(count_tokens(msg['content']) for msg in messages if isinstance(msg['content'], str))
-            },
-            'updated_at': datetime.datetime.now().isoformat()
-        })
+        # 检查聊天历史归属并获取已保存的消息数量
+        cursor.execute(
+            "SELECT h.id, (SELECT COUNT(*) FROM chat_messages m WHERE m.chat_history_id = h.id) AS stored "
+            "FROM chat_histories h WHERE h.id = %s AND h.user_id = %s",
+            (chat_history_id, user_id)
+        )
+        result = cursor.fetchone()
+        if not result:
+            raise ChatHistoryNotFoundError(f"未找到要更新的聊天历史记录 (ID: {chat_history_id}, 用户ID: {user_id})")
+        
+        stored = result['stored']
+        if base_seq is not None:
+            new_messages = unsaved_chat_messages(cursor, chat_history_id, messages, min(base_seq, stored))
+            added = append_chat_messages(cursor, chat_history_id, user_id, new_messages, start_seq=stored)
+        elif len(messages) < stored:
+            logger.warning(f"会话消息数({len(messages)})少于已保存的消息数({stored})，跳过保存 (聊天历史ID: {chat_history_id})")
+            added = 0
+        else:
+            added = append_chat_messages(cursor, chat_history_id, user_id, messages[stored:], start_seq=stored)
 
-        # 更新聊天历史记录
+        # 消息已迁移到chat_messages表，清空旧格式的session_data
         cursor.execute(
-            "UPDATE chat_histories SET session_data = %s, updated_at = NOW() WHERE id = %s AND user_id = %s",
-            (session_json, chat_history_id, user_id)
+            "UPDATE chat_histories SET session_data = NULL, updated_at = NOW() WHERE id = %s",
+            (chat_history_id,)
         )
-        
-        if cursor.rowcount == 0:
-            logger.warning(f"未找到要更新的聊天历史记录 (ID: {chat_history_id}, 用户ID: {user_id})")
-            conn.close()
-            return False
 
         conn.commit()
+        logger.info(f"成功保存用户会话 (用户ID: {user_id}, 聊天历史ID: {chat_history_id}, 新增消息: {added})")
+        return chat_history_id
+    finally:
         conn.close()
-        logger.info(f"成功保存用户会话 (用户ID: {user_id}, 聊天历史ID: {chat_history_id})")
+
+def save_user_session(user_id, session_data, chat_history_id=None, base_seq=None):
+    """
+    保存用户会话数据到数据库，参数见store_chat_messages
+    :return: 保存是否成功
+    """
+    try:
+        store_chat_messages(user_id, session_data, chat_history_id, base_seq)
         return True
+    except ChatHistoryNotFoundError as e:
+        logger.warning(str(e))
+        return False
     except Exception as e:
         logger.error(f"保存用户会话失败: {str(e)}")
         return False
@@ -346,6 +1780,7 @@ def save_user_session(user_id, session_data, chat_history_id=None):
 def load_user_session(user_id, chat_history_id=None):
     """
     从数据库加载用户会话数据
+    优先读取chat_messages表，尚未迁移的会话从session_data读取
     :param user_id: 用户ID
     :param chat_history_id: 聊天历史记录ID（可选）
     :return: 会话数据
@@ -357,33 +1792,47 @@ def load_user_session(user_id, chat_history_id=None):
         # 如果没有提供聊天历史ID，查找用户的默认会话
         if not chat_history_id:
             cursor.execute(
-                "SELECT id, session_data FROM chat_histories WHERE user_id = %s ORDER BY updated_at DESC LIMIT 1",
+                "SELECT id, session_data, summary, summary_upto_seq FROM chat_histories "
+                "WHERE user_id = %s ORDER BY updated_at DESC LIMIT 1",
                 (user_id,)
             )
         else:
             cursor.execute(
-                "SELECT id, session_data FROM chat_histories WHERE id = %s AND user_id = %s",
+                "SELECT id, session_data, summary, summary_upto_seq FROM chat_histories WHERE id = %s AND user_id = %s",
                 (chat_history_id, user_id)
             )
 
         result = cursor.fetchone()
+        if not result:
+            conn.close()
+            logger.warning(f"未找到用户会话 (用户ID: {user_id}, 聊天历史ID: {chat_history_id})")
+            return {'success': False, 'message': '未找到会话数据'}
+        
+        messages = fetch_chat_messages(cursor, result['id'])
         conn.close()
 
-        if result and result['session_data']:
+        if not messages and result['session_data']:
+            # 旧格式：整个会话保存在session_data中
+            # 解析失败时返回错误而不是空会话，避免之后的保存清空session_data
             try:
-                session_data = json.loads(result['session_data'])
-                return {
-                    'success': True, 
-                    'messages': session_data.get('messages', []),
-                    'token_count': session_data.get('token_count', {}),
-                    'chat_id': result['id']
-                }
+                legacy_data = json.loads(result['session_data'])
             except json.JSONDecodeError:
                 logger.error(f"解析会话数据JSON失败 (聊天历史ID: {result['id']})")
                 return {'success': False, 'message': '解析会话数据失败'}
-        else:
-            logger.warning(f"未找到用户会话 (用户ID: {user_id}, 聊天历史ID: {chat_history_id})")
-            return {'success': False, 'message': '未找到会话数据'}
+            # 旧数据可能是消息数组、{'messages': [...]}或{'messages_<用户ID>': [...]}
+            messages = extract_session_messages(user_id, legacy_data)
+        
+        summary = None
+        if result['summary'] and result['summary_upto_seq'] <= len(messages):
+            summary = {'content': result['summary'], 'upto_seq': result['summary_upto_seq']}
+        
+        return {
+            'success': True, 
+            'messages': messages,
+            'token_count': summarize_token_count(messages),
+            'chat_id': result['id'],
+            'summary': summary
+        }
     except Exception as e:
         logger.error(f"加载用户会话失败: {str(e)}")
         return {'success': False, 'message': f'加载会话数据时出错: {str(e)}'}
@@ -397,6 +1846,7 @@ def create_chat_history(user_id, title, session_data=None):
     :param session_data: 会话数据（可以是消息数组或包含消息数组的字典）
     :return: 新创建的聊天历史ID，如果创建失败则返回None
     """
+    conn = None
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -404,59 +1854,19 @@ def create_chat_history(user_id, title, session_data=None):
         # 确保title不为空
         if not title:
             title = "新对话"
-            
-        # 处理会话数据
-        if session_data:
-            # 确保session_data是JSON格式
-            if isinstance(session_data, list):
-                # 消息数组
-                messages = session_data
-                session_json = json.dumps({
-                    'messages': messages,
-                    'token_count': {
-                        'user_tokens': sum(count_tokens(msg['content']) for msg in messages if msg['role'] == 'user' and isinstance(msg['content'], str)),
-                        'assistant_tokens': sum(count_tokens(msg['content']) for msg in messages if msg['role'] == 'assistant' and isinstance(msg['content'], str)),
-                        'total': sum(count_tokens(msg['content']) for msg in messages if isinstance(msg['content'], str))
-                    },
-                    'updated_at': datetime.datetime.now().isoformat()
-                })
-            elif isinstance(session_data, dict):
-                # 含有messages_key的字典
-                user_messages_key = f'messages_{user_id}'
-                if user_messages_key in session_data:
-                    messages = session_data[user_messages_key]
-                    session_json = json.dumps({
-                        'messages': messages,
-                        'token_count': {
-                            'user_tokens': sum(count_tokens(msg['content']) for msg in messages if msg['role'] == 'user' and isinstance(msg['content'], str)),
-                            'assistant_tokens': sum(count_tokens(msg['content']) for msg in messages if msg['role'] == 'assistant' and isinstance(msg['content'], str)),
-                            'total': sum(count_tokens(msg['content']) for msg in messages if isinstance(msg['content'], str))
-                        },
-                        'updated_at': datetime.datetime.now().isoformat()
-                    })
-                else:
-                    # 已经是正确格式的字典
-                    session_json = json.dumps(session_data)
-            else:
-                # 字符串或其他格式，直接使用
-                session_json = session_data if isinstance(session_data, str) else json.dumps(session_data)
-        else:
-            # 空会话数据
-            session_json = json.dumps({
-                'messages': [],
-                'token_count': {'user_tokens': 0, 'assistant_tokens': 0, 'total': 0},
-                'updated_at': datetime.datetime.now().isoformat()
-            })
         
         # 插入数据
         cursor.execute(
-            "INSERT INTO chat_histories (user_id, title, session_data, created_at, updated_at) VALUES (%s, %s, %s, NOW(), NOW())",
-            (user_id, title, session_json)
+            "INSERT INTO chat_histories (user_id, title, created_at, updated_at) VALUES (%s, %s, NOW(), NOW())",
+            (user_id, title)
         )
         
         # 获取新插入的ID
         chat_history_id = cursor.lastrowid
         
+        # 保存初始消息
+        append_chat_messages(cursor, chat_history_id, user_id, extract_session_messages(user_id, session_data))
+        
         conn.commit()
         conn.close()
         
@@ -464,116 +1874,530 @@ def create_chat_history(user_id, title, session_data=None):
         return chat_history_id
     except Exception as e:
         logger.error(f"创建聊天历史失败: {str(e)}")
+        if conn:
+            conn.close()
         return None
 
+# 会话保存写后队列：回复先返回给用户，消息由后台线程写入数据库
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "1").lower() in ('1', 'true')
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "3"))
+WRITE_BEHIND_FLUSH_TIMEOUT = float(os.getenv("WRITE_BEHIND_FLUSH_TIMEOUT", "10"))  # 进程退出时等待写入的最长时间
+
+class WriteBehindQueue:
+    """
+    按聊天ID排队的会话写入队列
+    消息只追加：同一对话中新快照以排队中的快照为前缀时合并为一次写入（base_seq取较小的），
+    否则（两个请求基于同一段历史）按入队顺序分别写入，由save_user_session按base_seq追加并记录冲突。
+    同一对话同时只有一个写入；失败的写入按退避时间重新排期，不阻塞其他对话，
+    permanent_errors中的错误（如对话已删除）直接放弃。
+    写入完成前load_chat_messages和load_owned_chat_window读取队列中的快照，保证本进程内读到最新消息
+    """
+
+    def __init__(self, writer, max_retries=WRITE_BEHIND_MAX_RETRIES, retry_delay=1.0, permanent_errors=()):
+        self._writer = writer
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.permanent_errors = permanent_errors
+        # 聊天ID -> 待写入项列表（按入队顺序），每项为
+        # {'user_id', 'messages', 'base_seq', 'attempts', 'ready_at', 'writing'}
+        self._chats = OrderedDict()
+        self._cond = threading.Condition()
+        self._started = False
+        self.enqueued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def _start(self):
+        threading.Thread(target=self._run, name='write-behind', daemon=True).start()
+        atexit.register(self.flush, WRITE_BEHIND_FLUSH_TIMEOUT)
+        self._started = True
+        logger.info("会话写入队列已启动")
+
+    @staticmethod
+    def _is_prefix(prefix, messages):
+        return len(prefix) <= len(messages) and all(
+            same_message(a, b) for a, b in zip(prefix, messages))
+
+    @staticmethod
+    def _merge_base(a, b):
+        if a is None or b is None:
+            return None
+        return min(a, b)
+
+    def enqueue(self, chat_id, user_id, messages, base_seq=None):
+        snapshot = list(messages)
+        with self._cond:
+            if not self._started:
+                self._start()
+            entries = self._chats.setdefault(chat_id, [])
+            tail = entries[-1] if entries else None
+            if tail and not tail['writing'] and self._is_prefix(tail['messages'], snapshot):
+                tail['messages'] = snapshot
+                tail['base_seq'] = self._merge_base(tail['base_seq'], base_seq)
+                self.coalesced += 1
+            else:
+                entries.append({'user_id': user_id, 'messages': snapshot, 'base_seq': base_seq,
+                                'attempts': 0, 'ready_at': 0.0, 'writing': False})
+            self.enqueued += 1
+            self._cond.notify()
+
+    def pending_messages(self, chat_id):
+        """
+        获取尚未写入数据库的消息快照，没有时返回None
+        多个分叉的快照按写入时的处理方式合并：后一个快照中base_seq之后的消息追加在前一个之后
+        """
+        with self._cond:
+            entries = self._chats.get(chat_id)
+            if not entries:
+                return None
+            merged = list(entries[0]['messages'])
+            for entry in entries[1:]:
+                if self._is_prefix(merged, entry['messages']):
+                    merged = list(entry['messages'])
+                else:
+                    base = entry['base_seq'] if entry['base_seq'] is not None else len(merged)
+                    merged.extend(entry['messages'][base:])
+            return merged
+
+    def _next_ready(self, now):
+        """返回(聊天ID, 待写入项)或None，以及最早可以重试的时间"""
+        next_at = None
+        for chat_id, entries in self._chats.items():
+            head = entries[0]
+            if head['writing']:
+                continue
+            if head['ready_at'] <= now:
+                return (chat_id, head), None
+            next_at = head['ready_at'] if next_at is None else min(next_at, head['ready_at'])
+        return None, next_at
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    item, next_at = self._next_ready(now)
+                    if item:
+                        break
+                    self._cond.wait(next_at - now if next_at is not None else None)
+                chat_id, entry = item
+                entry['writing'] = True
+            
+            error = None
+            try:
+                self._writer(entry['user_id'], entry['messages'], chat_id, entry['base_seq'])
+            except Exception as e:
+                error = e
+            
+            with self._cond:
+                entry['writing'] = False
+                entries = self._chats[chat_id]
+                if error is None:
+                    self.written += 1
+                    entries.pop(0)
+                else:
+                    self.failures += 1
+                    entry['attempts'] += 1
+                    if isinstance(error, self.permanent_errors) or entry['attempts'] >= self.max_retries:
+                        self.dropped += 1
+                        entries.pop(0)
+                        logger.error(f"会话保存失败，已放弃 (聊天历史ID: {chat_id}, 消息数: {len(entry['messages'])}, "
+                                     f"尝试次数: {entry['attempts']}): {str(error)}")
+                    else:
+                        # 按退避时间重新排期，期间其他对话照常写入
+                        entry['ready_at'] = time.time() + self.retry_delay * (2 ** (entry['attempts'] - 1))
+                        logger.warning(f"后台保存会话失败，稍后重试 (聊天历史ID: {chat_id}): {str(error)}")
+                if entries:
+                    self._chats.move_to_end(chat_id)
+                else:
+                    del self._chats[chat_id]
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """等待队列中的写入全部完成，返回是否已清空"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while self._chats:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    logger.warning(f"等待会话写入超时，仍有 {len(self._chats)} 个对话未保存")
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._cond:
+            entries = [entry for chat_entries in self._chats.values() for entry in chat_entries]
+            writing = sum(1 for entry in entries if entry['writing'])
+            return {
+                'enabled': WRITE_BEHIND_ENABLED,
+                'pending': len(entries) - writing,
+                'writing': writing,
+                'retrying': sum(1 for entry in entries if entry['attempts'] and not entry['writing']),
+                'enqueued': self.enqueued,
+                'coalesced': self.coalesced,
+                'written': self.written,
+                'failures': self.failures,
+                'dropped': self.dropped
+            }
+
+write_behind = WriteBehindQueue(
+    lambda user_id, messages, chat_id, base_seq: store_chat_messages(user_id, messages, chat_id, base_seq),
+    permanent_errors=(ChatHistoryNotFoundError, mysql.connector.errors.ProgrammingError,
+                      mysql.connector.errors.DataError, ValueError, TypeError))
+
+def persist_chat(user_id, messages, chat_id, base_seq=None):
+    """
+    保存已有对话的消息，启用写后队列时立即返回
+    :param base_seq: 本轮对话开始时加载的消息数，用于检测并发写入冲突
+    """
+    if WRITE_BEHIND_ENABLED:
+        write_behind.enqueue(chat_id, user_id, messages, base_seq)
+    else:
+        save_user_session(user_id, messages, chat_id, base_seq)
+
+# 聊天历史列表分页游标
+def encode_history_cursor(history):
+    """根据一页中最后一条记录的(updated_at, id)生成游标"""
+    value = json.dumps([history['updated_at'].strftime('%Y-%m-%d %H:%M:%S'), history['id']])
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+def decode_history_cursor(cursor):
+    """解析游标，返回(updated_at, id)，格式错误时抛出ValueError"""
+    try:
+        updated_at, history_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        datetime.datetime.strptime(updated_at, '%Y-%m-%d %H:%M:%S')
+        return updated_at, int(history_id)
+    except Exception:
+        raise ValueError(f"无效的分页游标: {cursor}")
+
 # 获取用户的所有聊天历史记录
-def get_chat_histories(user_id, limit=20):
-    """获取用户的所有聊天历史记录，按更新时间倒序"""
+def get_chat_histories(user_id, limit=CHAT_HISTORY_PAGE_SIZE, before=None):
+    """
+    获取用户的聊天历史记录，按更新时间倒序，基于(updated_at, id)分页
+    :param before: 上一页返回的游标解析后的(updated_at, id)
+    :return: (聊天历史记录列表, 下一页游标)，没有更多记录时游标为None
+    """
     try:
         conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
         
-        cursor.execute('''
-            SELECT id, title, created_at, updated_at
-            FROM chat_histories
-            WHERE user_id = %s AND is_active = 1
-            ORDER BY updated_at DESC
-            LIMIT %s
-        ''', (user_id, limit))
+        if before:
+            before_updated_at, before_id = before
+            cursor.execute('''
+                SELECT id, title, created_at, updated_at
+                FROM chat_histories
+                WHERE user_id = %s AND is_active = 1
+                AND (updated_at < %s OR (updated_at = %s AND id < %s))
+                ORDER BY updated_at DESC, id DESC
+                LIMIT %s
+            ''', (user_id, before_updated_at, before_updated_at, before_id, limit + 1))
+        else:
+            cursor.execute('''
+                SELECT id, title, created_at, updated_at
+                FROM chat_histories
+                WHERE user_id = %s AND is_active = 1
+                ORDER BY updated_at DESC, id DESC
+                LIMIT %s
+            ''', (user_id, limit + 1))
         
         histories = cursor.fetchall()
         
         cursor.close()
         conn.close()
         
+        next_cursor = None
+        if len(histories) > limit:
+            histories = histories[:limit]
+            next_cursor = encode_history_cursor(histories[-1])
+        
         logger.info(f"获取了用户 {user_id} 的 {len(histories)} 条聊天历史记录")
-        return histories
+        return histories, next_cursor
     except Exception as e:
         logger.error(f"获取聊天历史记录失败: {str(e)}")
-        return []
+        return [], None
 
-# 获取特定的聊天历史记录
-def get_chat_history(chat_history_id):
-    """获取特定的聊天历史记录"""
+# 聊天历史的单条记录操作：归属检查和操作在同一条语句、同一个连接中完成，
+# 记录不存在和不属于当前用户同样视为未找到
+def get_owned_chat_history(cursor, user_id, chat_history_id):
+    """
+    读取属于该用户的聊天历史，同时汇总整个会话的token数
+    :return: (聊天历史, token统计)，未找到时返回(None, None)
+    """
+    cursor.execute('''
+        SELECT h.id, h.user_id, h.title, h.created_at, h.updated_at,
+               h.session_data IS NOT NULL AS has_legacy_data,
+               COUNT(m.id) AS message_count,
+               COALESCE(SUM(CASE WHEN m.role = 'user' THEN m.token_count END), 0) AS user_tokens,
+               COALESCE(SUM(CASE WHEN m.role = 'assistant' THEN m.token_count END), 0) AS assistant_tokens,
+               COALESCE(SUM(m.token_count), 0) AS total_tokens
+        FROM chat_histories h
+        LEFT JOIN chat_messages m ON m.chat_history_id = h.id
+        WHERE h.id = %s AND h.user_id = %s AND h.is_active = 1
+        GROUP BY h.id
+    ''', (chat_history_id, user_id))
+    row = cursor.fetchone()
+    if not row:
+        return None, None
+    token_count = {
+        'user_tokens': int(row.pop('user_tokens')),
+        'assistant_tokens': int(row.pop('assistant_tokens')),
+        'total': int(row.pop('total_tokens'))
+    }
+    return row, token_count
+
+def load_owned_chat_window(user_id, chat_history_id, limit=CHAT_MESSAGE_WINDOW, before_seq=None):
+    """
+    在一个连接上读取属于该用户的聊天历史及其最近limit条消息（或before_seq之前的limit条）
+    token统计覆盖整个会话
+    :return: 会话数据，未找到时返回None；before为继续向前加载时使用的游标
+    """
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
         cursor = conn.cursor(dictionary=True)
-        
-        cursor.execute('''
-            SELECT id, user_id, title, created_at, updated_at
-            FROM chat_histories
-            WHERE id = %s AND is_active = 1
-        ''', (chat_history_id,))
-        
-        history = cursor.fetchone()
-        
-        cursor.close()
-        conn.close()
-        
-        if history:
-            logger.info(f"获取了聊天历史记录 (ID: {chat_history_id})")
+        history, token_count = get_owned_chat_history(cursor, user_id, chat_history_id)
+        if not history:
+            logger.warning(f"未找到聊天历史记录 (ID: {chat_history_id}, 用户ID: {user_id})")
+            return None
+        
+        message_count = history.pop('message_count')
+        # 写后队列中还有未写入的消息时以队列中的快照为准
+        full_messages = write_behind.pending_messages(chat_history_id)
+        if full_messages is not None and len(full_messages) <= message_count:
+            full_messages = None
+        if full_messages is None and not message_count and history['has_legacy_data']:
+            # 尚未迁移的旧格式会话保存在session_data中
+            cursor.execute("SELECT session_data FROM chat_histories WHERE id = %s", (chat_history_id,))
+            full_messages = extract_session_messages(user_id, cursor.fetchone()['session_data'])
+        
+        if full_messages is not None:
+            # 按与chat_messages.seq相同的下标截取
+            end = len(full_messages) if before_seq is None else min(before_seq, len(full_messages))
+            first_seq = max(end - limit, 0)
+            has_more = first_seq > 0
+            messages = full_messages[first_seq:end]
+            token_count = summarize_token_count(full_messages)
+        elif message_count:
+            messages, first_seq, has_more = fetch_chat_message_window(cursor, chat_history_id, limit, before_seq)
         else:
-            logger.warning(f"未找到聊天历史记录 (ID: {chat_history_id})")
+            messages, first_seq, has_more = [], 0, False
+        history.pop('has_legacy_data')
         
-        return history
-    except Exception as e:
-        logger.error(f"获取聊天历史记录失败: {str(e)}")
-        return None
+        return {
+            'history': history,
+            'messages': messages,
+            'token_count': token_count,
+            'has_more': has_more,
+            'before': first_seq if has_more else None
+        }
+    finally:
+        conn.close()
 
 # 更新聊天历史记录标题
-def update_chat_history_title(chat_history_id, new_title):
-    """更新聊天历史记录标题"""
+def update_chat_history_title(user_id, chat_history_id, new_title):
+    """
+    更新属于该用户的聊天历史记录标题
+    :return: 是否找到并更新了记录
+    """
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
         cursor = conn.cursor()
-        
-        cursor.execute('UPDATE chat_histories SET title = %s WHERE id = %s', 
-                      (new_title, chat_history_id))
-        
-        affected_rows = cursor.rowcount
-        
+        cursor.execute(
+            'UPDATE chat_histories SET title = %s WHERE id = %s AND user_id = %s AND is_active = 1',
+            (new_title, chat_history_id, user_id)
+        )
+        updated = cursor.rowcount > 0
         conn.commit()
-        cursor.close()
+    finally:
         conn.close()
-        
-        if affected_rows > 0:
-            logger.info(f"更新了聊天历史记录标题 (ID: {chat_history_id}, 新标题: {new_title})")
-            return True
-        else:
-            logger.warning(f"未找到聊天历史记录 (ID: {chat_history_id})")
-            return False
-    except Exception as e:
-        logger.error(f"更新聊天历史记录标题失败: {str(e)}")
-        return False
+    
+    if updated:
+        logger.info(f"更新了聊天历史记录标题 (ID: {chat_history_id}, 新标题: {new_title})")
+    else:
+        logger.warning(f"未找到聊天历史记录 (ID: {chat_history_id}, 用户ID: {user_id})")
+    return updated
 
 # 删除聊天历史记录（软删除）
-def delete_chat_history(chat_history_id):
-    """删除聊天历史记录（软删除）"""
+def delete_chat_history(user_id, chat_history_id):
+    """
+    软删除属于该用户的聊天历史记录
+    :return: 是否找到并删除了记录
+    """
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
         cursor = conn.cursor()
-        
-        cursor.execute('UPDATE chat_histories SET is_active = 0 WHERE id = %s', 
-                      (chat_history_id,))
-        
-        affected_rows = cursor.rowcount
-        
+        cursor.execute(
+            'UPDATE chat_histories SET is_active = 0 WHERE id = %s AND user_id = %s AND is_active = 1',
+            (chat_history_id, user_id)
+        )
+        deleted = cursor.rowcount > 0
         conn.commit()
-        cursor.close()
+    finally:
         conn.close()
-        
-        if affected_rows > 0:
-            logger.info(f"删除了聊天历史记录 (ID: {chat_history_id})")
-            return True
+    
+    if deleted:
+        logger.info(f"删除了聊天历史记录 (ID: {chat_history_id})")
+    else:
+        logger.warning(f"未找到聊天历史记录 (ID: {chat_history_id}, 用户ID: {user_id})")
+    return deleted
+
+# 启动预热
+def warm_up():
+    """预热：加载编码器、创建连接池和OpenAI客户端并初始化数据库"""
+    start_time = time.time()
+    get_encoder()
+    get_openai_client()
+    warm_up_openai_connections()
+    get_db_pool()  # 同时初始化数据库表结构
+    init_password_hash_prefix()
+    start_upload_sweeper()
+    start_usage_flusher()
+    logger.info(f"服务预热完成，耗时: {time.time() - start_time:.2f}秒")
+
+def create_app(warm=True):
+    """
+    应用工厂，供WSGI服务器使用，例如 gunicorn 'app:create_app()'
+    :param warm: 是否在返回前完成预热
+    """
+    if warm:
+        warm_up()
+    return app
+
+@app.cli.command('migrate-chat-messages')
+@click.option('--batch-size', default=100, show_default=True, help='每批迁移的聊天历史数量')
+def migrate_chat_messages(batch_size):
+    """将chat_histories.session_data中的旧格式会话迁移到chat_messages表"""
+    migrated = 0
+    last_id = 0
+    while True:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute('''
+            SELECT id, user_id, session_data FROM chat_histories
+            WHERE id > %s AND session_data IS NOT NULL
+            ORDER BY id LIMIT %s
+        ''', (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            conn.close()
+            break
+        for row in rows:
+            last_id = row['id']
+            cursor.execute("SELECT COUNT(*) AS stored FROM chat_messages WHERE chat_history_id = %s", (row['id'],))
+            if cursor.fetchone()['stored'] == 0:
+                messages = extract_session_messages(row['user_id'], row['session_data'])
+                append_chat_messages(cursor, row['id'], row['user_id'], messages)
+            cursor.execute("UPDATE chat_histories SET session_data = NULL, updated_at = updated_at WHERE id = %s", (row['id'],))
+            migrated += 1
+        conn.commit()
+        conn.close()
+        logger.info(f"已迁移 {migrated} 条聊天历史")
+    logger.info(f"迁移完成，共迁移 {migrated} 条聊天历史")
+
+@app.cli.command('compress-chat-messages')
+@click.option('--batch-size', default=500, show_default=True, help='每批处理的消息数量')
+@click.option('--codec', type=click.Choice(['zlib', 'zstd', 'none']), default=None,
+              help='目标存储格式，默认使用MESSAGE_COMPRESSION；none为全部解压')
+def compress_chat_messages(batch_size, codec):
+    """按当前存储格式重新编码chat_messages中已有的消息"""
+    codec = codec or MESSAGE_COMPRESSION
+    if codec == 'zstd' and zstandard is None:
+        raise click.ClickException("未安装zstandard")
+    # 只处理格式与目标不同的行：压缩时跳过已是该算法的行，解压时只处理已压缩的行
+    pattern = '%+%' if codec == 'none' else f'%+{codec}'
+    condition = "content_format LIKE %s" if codec == 'none' else "content_format NOT LIKE %s"
+    scanned = converted = 0
+    bytes_before = bytes_after = 0
+    last_id = 0
+    while True:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            f"SELECT id, content, content_blob, content_format FROM chat_messages "
+            f"WHERE id > %s AND {condition} ORDER BY id LIMIT %s",
+            (last_id, pattern, batch_size)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            conn.close()
+            break
+        updates = []
+        for row in rows:
+            last_id = row['id']
+            scanned += 1
+            content, content_blob, content_format = encode_message_content(
+                decode_message_content(row['content'], row['content_blob'], row['content_format']), codec)
+            if content_format == row['content_format']:
+                continue
+            bytes_before += len(row['content'].encode('utf-8')) + len(row['content_blob'] or b'')
+            bytes_after += len(content.encode('utf-8')) + len(content_blob or b'')
+            updates.append((content, content_blob, content_format, row['id']))
+        if updates:
+            cursor.executemany(
+                "UPDATE chat_messages SET content = %s, content_blob = %s, content_format = %s WHERE id = %s",
+                updates
+            )
+            converted += len(updates)
+        conn.commit()
+        conn.close()
+        logger.info(f"已检查 {scanned} 条消息，转换 {converted} 条")
+    logger.info(f"转换完成，共转换 {converted} 条消息，存储大小 {bytes_before} -> {bytes_after} 字节")
+
+@app.cli.command('dedupe-uploads')
+def dedupe_uploads():
+    """将上传目录中旧的uuid前缀文件改为按内容哈希命名，删除重复内容"""
+    upload_path = os.path.join(app.root_path, UPLOAD_FOLDER)
+    renamed = removed = 0
+    freed = 0
+    for name in sorted(os.listdir(upload_path)):
+        path = os.path.join(upload_path, name)
+        if not os.path.isfile(path) or name.startswith('.') or UPLOAD_BLOB_PATTERN.match(name):
+            continue
+        blob_name = upload_blob_name(DerivedImageCache.hash_file(path), name)
+        blob_path = os.path.join(upload_path, blob_name)
+        if os.path.exists(blob_path):
+            freed += os.path.getsize(path)
+            os.remove(path)
+            removed += 1
         else:
-            logger.warning(f"未找到聊天历史记录 (ID: {chat_history_id})")
-            return False
-    except Exception as e:
-        logger.error(f"删除聊天历史记录失败: {str(e)}")
-        return False
+            os.replace(path, blob_path)
+            renamed += 1
+    logger.info(f"上传文件去重完成: 重命名 {renamed} 个，删除重复 {removed} 个，释放 {freed} bytes")
 
-# 初始化数据库
-init_db()
+@app.cli.command('sweep-uploads')
+def sweep_uploads_command():
+    """按保留策略立即清理一次上传文件（可用于cron）"""
+    sweep_uploads()
+
+@app.cli.command('bench-password-hash')
+@click.option('--method', 'methods', multiple=True,
+              help='要测试的哈希方法，可重复指定；默认测试当前配置和几组常用参数')
+@click.option('--seconds', default=2.0, show_default=True, help='每种方法的测试时长')
+def bench_password_hash(methods, seconds):
+    """测试各哈希参数下单核每秒可完成的密码校验次数，用于估算登录容量"""
+    methods = methods or (PASSWORD_HASH_METHOD, 'pbkdf2:sha256:600000', 'pbkdf2:sha256:260000',
+                          'scrypt:32768:8:1', 'scrypt:16384:8:1')
+    password = 'benchmark-password-123'
+    click.echo(f"{'method':<28}{'ms/login':>10}{'logins/s/core':>16}")
+    for method in methods:
+        pwhash = generate_password_hash(password, method=method)
+        count = 0
+        start_time = time.perf_counter()
+        deadline = start_time + seconds
+        while time.perf_counter() < deadline or count == 0:
+            check_password_hash(pwhash, password)
+            count += 1
+        elapsed = time.perf_counter() - start_time
+        click.echo(f"{pwhash.split('$', 1)[0]:<28}{elapsed / count * 1000:>10.1f}{count / elapsed:>16.1f}")
+
+@app.cli.command('warm-tiktoken-cache')
+def warm_tiktoken_cache():
+    """下载tiktoken的BPE文件到本地缓存目录，部署后即可离线启动"""
+    os.makedirs(TIKTOKEN_CACHE_DIR, exist_ok=True)
+    get_encoder()
+    logger.info(f"tiktoken缓存已写入: {TIKTOKEN_CACHE_DIR}")
 
 @app.route('/')
 def root():
@@ -605,41 +2429,52 @@ def login():
             # 首先验证验证码是否有效
             valid_code = verify_code(username, verification_code)
             if not valid_code:
+                cursor.close()
+                conn.close()
                 return jsonify({'success': False, 'message': '验证码无效或已过期'})
             
             # 验证码有效，查询用户信息
-            cursor.execute('SELECT id, username FROM users WHERE phone = %s', (username,))
+            cursor.execute('SELECT id, username, response_cache_enabled FROM users WHERE phone = %s', (username,))
             result = cursor.fetchone()
             
             if not result:
                 # 用户不存在，验证码登录失败
+                cursor.close()
+                conn.close()
                 return jsonify({'success': False, 'message': '该手机号未注册'})
             
-            # 标记验证码为已使用
-            mark_code_used(username, verification_code)
+            # 标记验证码为已使用，并发请求中只有一个能成功
+            if not mark_code_used(username, verification_code):
+                cursor.close()
+                conn.close()
+                return jsonify({'success': False, 'message': '验证码无效或已过期'})
             
         elif is_phone:
             # 通过手机号和密码登录
-            cursor.execute('SELECT id, username, password_hash FROM users WHERE phone = %s', (username,))
+            cursor.execute('SELECT id, username, password_hash, response_cache_enabled FROM users WHERE phone = %s', (username,))
             result = cursor.fetchone()
             if not result or not check_password_hash(result['password_hash'], password):
                 cursor.close()
                 conn.close()
                 return jsonify({'success': False, 'message': '手机号或密码错误'})
+            rehash_password_if_needed(cursor, result, password)
                 
         else:
             # 通过用户名和密码登录
-            cursor.execute('SELECT id, username, password_hash FROM users WHERE username = %s', (username,))
+            cursor.execute('SELECT id, username, password_hash, response_cache_enabled FROM users WHERE username = %s', (username,))
             result = cursor.fetchone()
             if not result or not check_password_hash(result['password_hash'], password):
                 cursor.close()
                 conn.close()
                 return jsonify({'success': False, 'message': '用户名或密码错误'})
+            rehash_password_if_needed(cursor, result, password)
         
-        # 登录成功，设置会话
+        # 登录成功，更换会话ID后设置会话
+        regenerate_session()
         user_id = result['id']
         session['user_id'] = user_id
         session['username'] = result['username']
+        session['response_cache_enabled'] = bool(result['response_cache_enabled'])
         
         # 恢复用户之前的会话历史
         user_messages_key = f'messages_{user_id}'
@@ -667,86 +2502,276 @@ def login():
         logger.error(f"登录过程发生错误: {str(e)}")
         return jsonify({'success': False, 'message': f'服务器内部错误: {str(e)}'}), 500
 
+# 密码哈希
+def hash_password(password):
+    """按配置的方法和参数生成密码哈希"""
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+_password_hash_prefix = None
+
+def init_password_hash_prefix():
+    """
+    计算并校验当前配置对应的完整方法前缀（包含werkzeug补全的默认参数），如 pbkdf2:sha256:1000000
+    在warm_up中调用；配置无效时记录错误并关闭登录时的重新哈希
+    """
+    global _password_hash_prefix
+    try:
+        _password_hash_prefix = hash_password('').split('$', 1)[0]
+    except Exception as e:
+        logger.error(f"PASSWORD_HASH_METHOD配置无效({PASSWORD_HASH_METHOD})，登录时不会重新哈希密码: {str(e)}")
+        _password_hash_prefix = ''
+    return _password_hash_prefix
+
+def password_hash_prefix():
+    """当前配置对应的方法前缀，配置无效时为空字符串"""
+    if _password_hash_prefix is None:
+        return init_password_hash_prefix()
+    return _password_hash_prefix
+
+def rehash_password_if_needed(cursor, user, password):
+    """
+    密码验证通过后，如果哈希方法或参数与当前配置不同则重新哈希
+    只执行UPDATE，由调用方提交；失败时只记录日志，不影响登录
+    """
+    try:
+        prefix = password_hash_prefix()
+        if not prefix or user['password_hash'].split('$', 1)[0] == prefix:
+            return
+        cursor.execute('UPDATE users SET password_hash = %s WHERE id = %s', (hash_password(password), user['id']))
+        logger.info(f"用户 {user['username']} 的密码哈希已升级为 {prefix}")
+    except Exception as e:
+        logger.error(f"升级密码哈希失败: {str(e)}")
+
 # 生成验证码
 def generate_verification_code():
     """生成6位数字验证码"""
     import random
     return ''.join(random.choices('0123456789', k=6))
 
-# 保存验证码到数据库
+# 验证码存储：验证码只在有效期内使用，不需要每次读写MySQL
+# memory为进程内存储（单进程部署）；filesystem为本机文件存储，多个worker之间共享
+VERIFICATION_CODE_STORE = os.getenv("VERIFICATION_CODE_STORE", "memory").lower()
+VERIFICATION_CODE_DIR = os.getenv("VERIFICATION_CODE_DIR", os.path.join(app.root_path, 'verification_codes'))
+VERIFICATION_SEND_INTERVAL = int(os.getenv("VERIFICATION_SEND_INTERVAL", "60"))  # 同一手机号发送间隔（秒）
+VERIFICATION_MAX_ATTEMPTS = int(os.getenv("VERIFICATION_MAX_ATTEMPTS", "5"))  # 输错次数上限，超过后验证码失效
+# 是否同时将发送记录写入verification_codes表用于审计
+VERIFICATION_CODE_AUDIT = os.getenv("VERIFICATION_CODE_AUDIT", "").lower() in ('1', 'true')
+
+class VerificationCodeStore:
+    """
+    带过期时间的验证码存储
+    子类只需实现get/set/add/update/delete几个基本操作，update须是原子的读-改-写
+    """
+
+    @staticmethod
+    def _code_key(phone, code_type):
+        return f"code:{code_type}:{phone}"
+
+    @staticmethod
+    def _throttle_key(phone, code_type):
+        return f"sent:{code_type}:{phone}"
+
+    def acquire_send_slot(self, phone, code_type, interval=VERIFICATION_SEND_INTERVAL):
+        """同一手机号在间隔内只允许发送一次，返回是否允许发送"""
+        if interval <= 0:
+            return True
+        return self.add(self._throttle_key(phone, code_type), time.time() + interval, interval)
+
+    def send_wait_seconds(self, phone, code_type):
+        """距离下次允许发送的秒数"""
+        allowed_at = self.get(self._throttle_key(phone, code_type))
+        return max(int(allowed_at - time.time()) + 1, 1) if allowed_at else 0
+
+    def issue(self, phone, code_type, code, ttl=VERIFICATION_CODE_EXPIRE):
+        """保存新的验证码，同时使旧验证码失效"""
+        entry = {'code': code, 'attempts': 0, 'expires_at': time.time() + ttl}
+        self.set(self._code_key(phone, code_type), entry, ttl)
+
+    def verify(self, phone, code_type, code):
+        """验证码是否有效；输错次数超过上限后验证码失效"""
+        def check(entry):
+            if entry['code'] == code:
+                return entry, True
+            attempts = entry['attempts'] + 1
+            if attempts >= VERIFICATION_MAX_ATTEMPTS:
+                logger.warning(f"验证码输错次数过多，已失效: {phone}")
+                return None, False
+            return dict(entry, attempts=attempts), False
+        return self.update(self._code_key(phone, code_type), check, default=False)
+
+    def consume(self, phone, code_type, code):
+        """验证通过后删除验证码，保证只能使用一次"""
+        def take(entry):
+            if entry['code'] != code:
+                return entry, False
+            return None, True
+        return self.update(self._code_key(phone, code_type), take, default=False)
+
+class MemoryCodeStore(VerificationCodeStore):
+    """进程内验证码存储，定期清除过期数据"""
+
+    def __init__(self, sweep_interval=60):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._sweep_interval = sweep_interval
+        self._last_sweep = time.time()
+
+    def _sweep(self, now):
+        if now - self._last_sweep < self._sweep_interval:
+            return
+        self._last_sweep = now
+        for key in [k for k, (expires_at, _) in self._data.items() if expires_at <= now]:
+            del self._data[key]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            item = self._data.get(key)
+            if not item or item[0] <= now:
+                return None
+            return dict(item[1]) if isinstance(item[1], dict) else item[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+
+    def update(self, key, func, default=None):
+        """
+        在锁内读取并更新值，保持原有的过期时间
+        :param func: 接收当前值，返回(新值, 结果)，新值为None时删除
+        :return: func返回的结果，值不存在时返回default
+        """
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if not item or item[0] <= now:
+                return default
+            value, result = func(dict(item[1]))
+            if value is None:
+                del self._data[key]
+            else:
+                self._data[key] = (item[0], value)
+            return result
+
+    def add(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item and item[0] > now:
+                return False
+            self._data[key] = (now + ttl, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+class FileSystemCodeStore(VerificationCodeStore):
+    """基于cachelib文件缓存的验证码存储，同一台机器上的多个worker共享"""
+
+    def __init__(self, cache_dir):
+        self._cache = FileSystemCache(cache_dir, threshold=10000, default_timeout=VERIFICATION_CODE_EXPIRE)
+        # 锁文件放在缓存目录之外，避免被cachelib清理
+        self._lock_path = os.path.normpath(cache_dir) + '.lock'
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """跨进程互斥：进程内用线程锁，进程间用文件锁"""
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self._lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        with self._locked():
+            self._cache.set(key, value, timeout=ttl)
+
+    def update(self, key, func, default=None):
+        """在文件锁内读取并更新值，按保存时记录的expires_at保持原有的过期时间"""
+        with self._locked():
+            entry = self._cache.get(key)
+            if not entry:
+                return default
+            remaining = entry.get('expires_at', time.time() + VERIFICATION_CODE_EXPIRE) - time.time()
+            if remaining <= 0:
+                self._cache.delete(key)
+                return default
+            value, result = func(dict(entry))
+            if value is None:
+                self._cache.delete(key)
+            else:
+                self._cache.set(key, value, timeout=remaining)
+            return result
+
+    def add(self, key, value, ttl):
+        """键不存在或已过期时写入；cachelib的add只判断文件是否存在，过期的文件会一直占位"""
+        with self._locked():
+            if self._cache.get(key) is not None:
+                return False
+            return self._cache.set(key, value, timeout=ttl)
+
+    def delete(self, key):
+        with self._locked():
+            return self._cache.delete(key)
+
+if VERIFICATION_CODE_STORE == 'filesystem':
+    code_store = FileSystemCodeStore(VERIFICATION_CODE_DIR)
+else:
+    code_store = MemoryCodeStore()
+
+# 保存验证码
 def save_verification_code(phone, code, code_type='login'):
-    """保存验证码到数据库"""
+    """保存验证码，启用审计时同时写入数据库"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # 设置过期时间
-        expires_at = time.strftime('%Y-%m-%d %H:%M:%S', 
-                                   time.localtime(time.time() + VERIFICATION_CODE_EXPIRE))
-        
-        # 先将该手机号的旧验证码标记为已使用
-        cursor.execute('''
-            UPDATE verification_codes 
-            SET is_used = 1 
-            WHERE phone = %s AND type = %s AND is_used = 0
-        ''', (phone, code_type))
-        
-        # 插入新的验证码
-        cursor.execute('''
-            INSERT INTO verification_codes 
-            (phone, code, expires_at, type) 
-            VALUES (%s, %s, %s, %s)
-        ''', (phone, code, expires_at, code_type))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return True
+        code_store.issue(phone, code_type, code)
     except Exception as e:
         logger.error(f"保存验证码失败: {str(e)}")
         return False
+    
+    if VERIFICATION_CODE_AUDIT:
+        try:
+            conn = get_db_connection()
+            try:
+                expires_at = time.strftime('%Y-%m-%d %H:%M:%S',
+                                           time.localtime(time.time() + VERIFICATION_CODE_EXPIRE))
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO verification_codes 
+                    (phone, code, expires_at, type) 
+                    VALUES (%s, %s, %s, %s)
+                ''', (phone, code, expires_at, code_type))
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.warning(f"写入验证码审计记录失败: {str(e)}")
+    return True
 
 # 验证码是否有效
 def verify_code(phone, code, code_type='login'):
     """验证码是否有效"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        
-        # 查询未使用且在有效期内的验证码
-        cursor.execute('''
-            SELECT * FROM verification_codes 
-            WHERE phone = %s AND code = %s AND type = %s 
-            AND is_used = 0 AND expires_at > NOW()
-            ORDER BY created_at DESC LIMIT 1
-        ''', (phone, code, code_type))
-        
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        return result is not None
+        return code_store.verify(phone, code_type, code)
     except Exception as e:
         logger.error(f"验证验证码失败: {str(e)}")
         return False
 
 # 标记验证码为已使用
 def mark_code_used(phone, code, code_type='login'):
-    """标记验证码为已使用"""
+    """标记验证码为已使用（从存储中删除）"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE verification_codes 
-            SET is_used = 1 
-            WHERE phone = %s AND code = %s AND type = %s AND is_used = 0
-        ''', (phone, code, code_type))
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return True
+        return code_store.consume(phone, code_type, code)
     except Exception as e:
         logger.error(f"标记验证码已使用失败: {str(e)}")
         return False
@@ -788,6 +2813,11 @@ def send_verification_code():
             if not result:
                 return jsonify({'success': False, 'message': '该手机号未注册'})
         
+        # 同一手机号限制发送频率（放在手机号检查之后，被拒绝的请求不占用发送间隔）
+        if not code_store.acquire_send_slot(phone, code_type):
+            wait_seconds = code_store.send_wait_seconds(phone, code_type)
+            return jsonify({'success': False, 'message': f'发送过于频繁，请{wait_seconds}秒后再试'}), 429
+        
         # 生成6位验证码
         code = generate_verification_code()
         
@@ -847,8 +2877,8 @@ def register():
             logger.warning(f"验证码验证失败，手机号: {phone}")
             return jsonify({'success': False, 'message': '验证码无效或已过期'})
         
-        # 使用pbkdf2:sha256方法进行密码加密
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        # 按配置的哈希方法和参数加密密码
+        hashed_password = hash_password(password)
         
         # 数据库操作
         conn = None
@@ -969,6 +2999,130 @@ def logout():
         session.clear()
         return redirect(url_for('login'))
 
+# 解析聊天请求参数
+def parse_chat_request():
+    """从JSON或表单中解析聊天请求，返回(用户消息, 聊天ID, 图片路径)"""
+    image_path = None
+    if request.is_json:
+        data = request.get_json()
+        user_message = data.get('message', '')
+        chat_id = data.get('chat_id')
+    else:
+        user_message = request.form.get('message', '')
+        chat_id = request.form.get('chat_id')
+        original_image_path = request.form.get('image_path')
+        if original_image_path:
+            # 记录原始图片路径
+            logger.info(f"接收到图片路径: {original_image_path}")
+            image_path = original_image_path
+            
+            # 如果是相对于static的路径，确保正确处理
+            if image_path.startswith('static/'):
+                # 已经是相对路径，直接使用
+                logger.info(f"使用相对路径: {image_path}")
+            elif image_path.startswith('/static/'):
+                # 移除前导斜杠
+                image_path = image_path[1:]
+                logger.info(f"转换路径: {original_image_path} -> {image_path}")
+    return user_message, chat_id, image_path
+
+# 加载当前对话的消息历史
+def load_chat_messages(user_id, chat_id):
+    """
+    指定聊天ID时从数据库加载，否则从会话中获取消息历史
+    :return: (消息数组, 对话摘要)，未启用压缩或没有摘要时摘要为None
+    """
+    if chat_id:
+        # 如果指定了聊天ID，尝试加载该历史记录
+        result = load_user_session(user_id, chat_id)
+        if result['success']:
+            # 写后队列中还有未写入的消息时以队列中的为准
+            pending = write_behind.pending_messages(result['chat_id'])
+            messages = pending if pending is not None and len(pending) >= len(result['messages']) else result['messages']
+            return messages, result['summary'] if COMPACTION_ENABLED else None
+        # 如果加载失败，创建新的会话
+        return [], None
+    # 从会话中获取消息历史
+    return session.get(f'messages_{user_id}', []), None
+
+# 完成一轮对话：统计token、处理超限并保存
+def finish_chat_turn(user_id, chat_id, messages, user_message, ai_response, summary=None, base_seq=None):
+    """
+    将助手回复加入消息历史，统计token并保存会话
+    启用对话压缩时，以摘要加未总结消息的token数判断是否超限，并在超过阈值后提交后台压缩
+    :param summary: 对话摘要（可选）
+    :param base_seq: 本轮对话开始时加载的消息数（可选）
+    :return: 返回给前端的响应数据
+    """
+    # 添加助手回复
+    messages.append(new_message("assistant", ai_response))
+    
+    # 汇总token使用情况（每条消息的token数已缓存，无需重新编码）
+    token_count = summarize_token_count(messages)
+    total_user_tokens = token_count['user_tokens']
+    total_assistant_tokens = token_count['assistant_tokens']
+    
+    # 会话总token数
+    total_session_tokens = total_user_tokens + total_assistant_tokens
+    # 启用压缩时只有实际进入上下文的部分计入限制
+    context_tokens = effective_token_count(messages, summary) if COMPACTION_ENABLED else total_session_tokens
+    
+    # 检查token是否超出限制
+    token_limit_reached = False
+    system_message = None
+    new_chat_id = None
+    
+    if context_tokens >= USER_MAX_TOKENS:
+        token_limit_reached = True
+        system_message = f"已达到会话token限制({USER_MAX_TOKENS})，本次对话已保存到历史记录。"
+        
+        # 保存当前会话到历史记录
+        if chat_id:
+            persist_chat(user_id, messages, chat_id, base_seq)
+        else:
+            # 创建新的聊天历史记录
+            title = user_message[:20] + "..." if len(user_message) > 20 else user_message
+            chat_id = create_chat_history(user_id, title, messages)
+            
+        # 创建新的会话
+        title = f"新对话 {datetime.datetime.now().strftime('%m-%d %H:%M')}"
+        new_chat_id = create_chat_history(user_id, title)
+    
+    # 保存会话到数据库（已有对话通过写后队列异步保存）
+    if chat_id and not token_limit_reached:
+        persist_chat(user_id, messages, chat_id, base_seq)
+    elif not chat_id and not token_limit_reached:
+        # 如果没有聊天ID且未达到token限制，创建新的聊天历史
+        title = user_message[:20] + "..." if len(user_message) > 20 else user_message
+        chat_id = create_chat_history(user_id, title, messages)
+    
+    if COMPACTION_ENABLED and chat_id and not token_limit_reached and context_tokens >= COMPACTION_TRIGGER_TOKENS:
+        schedule_compaction(chat_id)
+    
+    # 准备响应数据
+    response_data = {
+        'success': True,
+        'response': ai_response,
+        'token_count': {
+            'user_tokens': total_user_tokens,
+            'assistant_tokens': total_assistant_tokens,
+            'session_total': total_session_tokens
+        },
+        'token_limit_reached': token_limit_reached,
+    }
+    
+    # 如果有聊天ID，添加到响应中
+    if chat_id:
+        response_data['chat_id'] = chat_id
+    
+    # 如果token超限，添加系统消息和新的聊天ID
+    if token_limit_reached:
+        response_data['system_message'] = system_message
+        if new_chat_id:
+            response_data['new_chat_id'] = new_chat_id
+    
+    return response_data
+
 # AI聊天相关路由
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -979,82 +3133,39 @@ def chat():
             return jsonify({'success': False, 'message': '请先登录'}), 401
         
         user_id = session['user_id']
-        user_name = session.get('username', '用户')
         
         # 获取请求数据
-        if request.is_json:
-            data = request.get_json()
-            user_message = data.get('message', '')
-            chat_id = data.get('chat_id')
-        else:
-            user_message = request.form.get('message', '')
-            chat_id = request.form.get('chat_id')
-            image_path = request.form.get('image_path')
+        user_message, chat_id, image_path = parse_chat_request()
         
         # 验证消息
         if not user_message and 'image_path' not in request.form:
             return jsonify({'success': False, 'message': '消息不能为空'}), 400
         
+        # 检查用户token额度（读取内存计数）
+        allowed, quota_message = usage_ledger.check(user_id)
+        if not allowed:
+            return jsonify({'success': False, 'message': quota_message}), 429
+        
         # 为每个用户创建独立的消息历史键
         user_messages_key = f'messages_{user_id}'
         
         # 初始化或获取当前用户的消息历史
-        if chat_id:
-            # 如果指定了聊天ID，尝试加载该历史记录
-            result = load_user_session(user_id, chat_id)
-            if result['success']:
-                messages = result['messages']
-                token_count = result.get('token_count', {})
-                current_session_tokens = token_count.get('total', 0)
-            else:
-                # 如果加载失败，创建新的会话
-                messages = []
-                current_session_tokens = 0
-        else:
-            # 从会话中获取消息历史
-            messages = session.get(user_messages_key, [])
-            
-            # 计算当前会话的token数量
-            current_session_tokens = 0
-            for msg in messages:
-                if isinstance(msg['content'], list):
-                    # 图像消息
-                    for part in msg['content']:
-                        if part['type'] == 'text':
-                            current_session_tokens += count_tokens(part['text'])
-                else:
-                    # 纯文本消息
-                    current_session_tokens += count_tokens(msg['content'])
+        messages, summary = load_chat_messages(user_id, chat_id)
+        base_seq = len(messages)
         
         # 添加用户消息
-        if 'image_path' in request.form and request.form['image_path']:
-            # 记录原始图片路径
-            original_image_path = request.form['image_path']
-            logger.info(f"接收到图片路径: {original_image_path}")
-            
-            # 处理图片路径，确保它是有效的
-            image_path = original_image_path
-            
-            # 如果是相对于static的路径，确保正确处理
-            if image_path.startswith('static/'):
-                # 已经是相对路径，直接使用
-                logger.info(f"使用相对路径: {image_path}")
-            elif image_path.startswith('/static/'):
-                # 移除前导斜杠
-                image_path = image_path[1:]
-                logger.info(f"转换路径: {original_image_path} -> {image_path}")
-            
+        if image_path:
             # 添加用户文本消息
             if user_message:
-                messages.append({"role": "user", "content": user_message})
+                messages.append(new_message("user", user_message))
             
             # 调用Vision API处理图片
             try:
                 logger.info(f"准备处理图片: {image_path}")
                 
-                # 检查图片文件是否存在
+                # 检查图片文件是否存在（已归档的图片自动恢复）
                 abs_path = os.path.join(app.root_path, image_path)
-                if not os.path.exists(abs_path):
+                if not restore_archived_upload(abs_path):
                     logger.error(f"图片文件不存在: {abs_path}")
                     return jsonify({
                         'success': False, 
@@ -1062,11 +3173,8 @@ def chat():
                     }), 404
                 
                 # 直接调用Vision API
-                ai_response = get_vision_response(image_path, user_message if user_message else "这张图片里有什么？")
-                
-                # 计算token
-                user_tokens = (count_tokens(user_message) if user_message else 0) + 500  # 用户文本token + 预估图片token
-                assistant_tokens = count_tokens(ai_response)
+                ai_response = get_vision_response(image_path, user_message if user_message else "这张图片里有什么？",
+                                                  user_id=user_id)
                 
                 logger.info(f"图片处理成功，生成回复长度: {len(ai_response)}")
             except Exception as e:
@@ -1078,105 +3186,416 @@ def chat():
                 }), 500
         else:
             # 纯文本消息
-            messages.append({"role": "user", "content": user_message})
+            messages.append(new_message("user", user_message))
             
             # 调用GPT API
             try:
-                ai_response, user_tokens, assistant_tokens = get_gpt_response(messages)
+                ai_response, user_tokens, assistant_tokens = get_gpt_response(
+                    build_prompt_messages(messages, summary), use_cache=session.get('response_cache_enabled', True),
+                    user_id=user_id)
             except Exception as e:
                 logger.error(f"调用GPT API出错: {str(e)}")
                 return jsonify({'success': False, 'message': f'调用AI服务时出错: {str(e)}'}), 500
-                
-        # 添加助手回复
-        messages.append({"role": "assistant", "content": ai_response})
         
-        # 重新计算token使用情况
-        total_user_tokens = 0
-        total_assistant_tokens = 0
+        response_data = finish_chat_turn(user_id, chat_id, messages, user_message, ai_response, summary, base_seq)
+        if image_path:
+            record_chat_upload(user_id, response_data.get('chat_id'), image_path)
         
-        for msg in messages:
-            if msg["role"] == "user":
-                if isinstance(msg['content'], list):
-                    # 图像消息
-                    for part in msg['content']:
-                        if part['type'] == 'text':
-                            total_user_tokens += count_tokens(part['text'])
-                else:
-                    # 纯文本消息
-                    total_user_tokens += count_tokens(msg['content'])
-            elif msg["role"] == "assistant":
-                total_assistant_tokens += count_tokens(msg['content'])
-        
-        # 会话总token数
-        total_session_tokens = total_user_tokens + total_assistant_tokens
-        
-        # 检查token是否超出限制
-        token_limit_reached = False
-        system_message = None
-        new_chat_id = None
-        
-        if total_session_tokens >= USER_MAX_TOKENS:
-            token_limit_reached = True
-            system_message = f"已达到会话token限制({USER_MAX_TOKENS})，本次对话已保存到历史记录。"
-            
-            # 保存当前会话到历史记录
-            if chat_id:
-                save_user_session(user_id, messages, chat_id)
-            else:
-                # 创建新的聊天历史记录
-                title = user_message[:20] + "..." if len(user_message) > 20 else user_message
-                chat_id = create_chat_history(user_id, title, messages)
-                
-            # 创建新的会话
-            title = f"新对话 {datetime.datetime.now().strftime('%m-%d %H:%M')}"
-            new_chat_id = create_chat_history(user_id, title)
-            
         # 更新session中的消息
         session[user_messages_key] = messages
         
-        # 保存会话到数据库
-        if chat_id and not token_limit_reached:
-            save_user_session(user_id, messages, chat_id)
-        elif not chat_id and not token_limit_reached:
-            # 如果没有聊天ID且未达到token限制，创建新的聊天历史
-            title = user_message[:20] + "..." if len(user_message) > 20 else user_message
-            chat_id = create_chat_history(user_id, title, messages)
+        return jsonify(response_data)
+    
+    except Exception as e:
+        logger.error(f"聊天处理出错: {str(e)}")
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'服务器内部错误: {str(e)}'}), 500
+
+# 格式化SSE事件
+def format_sse(event, data):
+    """将数据格式化为Server-Sent Events事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# 流式聊天接口
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    以SSE流式返回AI回复
+    事件类型：delta（回复片段）、done（最终结果及token用量）、error（处理失败）
+    """
+    try:
+        # 检查用户是否登录
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'message': '请先登录'}), 401
         
-        # 准备响应数据
-        response_data = {
-            'success': True,
-            'response': ai_response,
-            'token_count': {
-                'user_tokens': total_user_tokens,
-                'assistant_tokens': total_assistant_tokens,
-                'session_total': total_session_tokens
-            },
-            'token_limit_reached': token_limit_reached,
-        }
+        user_id = session['user_id']
+        
+        # 获取请求数据
+        user_message, chat_id, image_path = parse_chat_request()
+        
+        # 验证消息
+        if not user_message and 'image_path' not in request.form:
+            return jsonify({'success': False, 'message': '消息不能为空'}), 400
         
-        # 如果有聊天ID，添加到响应中
-        if chat_id:
-            response_data['chat_id'] = chat_id
+        # 检查用户token额度（读取内存计数）
+        allowed, quota_message = usage_ledger.check(user_id)
+        if not allowed:
+            return jsonify({'success': False, 'message': quota_message}), 429
         
-        # 如果token超限，添加系统消息和新的聊天ID
-        if token_limit_reached:
-            response_data['system_message'] = system_message
-            if new_chat_id:
-                response_data['new_chat_id'] = new_chat_id
+        # 初始化或获取当前用户的消息历史
+        messages, summary = load_chat_messages(user_id, chat_id)
+        base_seq = len(messages)
         
-        return jsonify(response_data)
+        if image_path:
+            # 检查图片文件是否存在（已归档的图片自动恢复）
+            abs_path = os.path.join(app.root_path, image_path)
+            if not restore_archived_upload(abs_path):
+                logger.error(f"图片文件不存在: {abs_path}")
+                return jsonify({
+                    'success': False, 
+                    'message': f'图片文件不存在: {abs_path}，请重新上传'
+                }), 404
+            
+            # 添加用户文本消息
+            if user_message:
+                messages.append(new_message("user", user_message))
+            chunks = stream_vision_response(image_path, user_message if user_message else "这张图片里有什么？",
+                                            user_id=user_id)
+        else:
+            # 纯文本消息
+            messages.append(new_message("user", user_message))
+            chunks = stream_gpt_response(build_prompt_messages(messages, summary),
+                                         use_cache=session.get('response_cache_enabled', True), user_id=user_id)
+        
+        def generate():
+            answer_parts = []
+            usage = None
+            try:
+                for event, data in chunks:
+                    if event == 'delta':
+                        answer_parts.append(data)
+                        yield format_sse('delta', {'content': data})
+                    elif event == 'usage':
+                        usage = data
+                
+                # 流结束后保存完整回复
+                ai_response = ''.join(answer_parts).strip()
+                response_data = finish_chat_turn(user_id, chat_id, messages, user_message, ai_response, summary, base_seq)
+                response_data['usage'] = usage
+                if image_path:
+                    record_chat_upload(user_id, response_data.get('chat_id'), image_path)
+                
+                # 服务端会话在响应头发出后仍可写入；cookie会话则以数据库为准
+                if not isinstance(app.session_interface, SecureCookieSessionInterface):
+                    session[f'messages_{user_id}'] = messages
+                    app.session_interface.save_session(app, session, response)
+                
+                yield format_sse('done', response_data)
+            except Exception as e:
+                logger.error(f"流式聊天处理出错: {str(e)}")
+                logger.error(f"错误详情: {traceback.format_exc()}")
+                yield format_sse('error', {'success': False, 'message': f'服务器内部错误: {str(e)}'})
+        
+        # 使用cookie会话时，响应头发出后无法再写入会话，
+        # 前端通过done事件中的chat_id继续后续对话
+        response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'  # 禁用Nginx缓冲
+        return response
     
     except Exception as e:
-        logger.error(f"聊天处理出错: {str(e)}")
+        logger.error(f"流式聊天处理出错: {str(e)}")
         traceback.print_exc()
         return jsonify({'success': False, 'message': f'服务器内部错误: {str(e)}'}), 500
 
+# 预处理后图片的缓存：内存中保存base64，磁盘上保存压缩后的JPEG
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(app.root_path, 'image_cache'))
+IMAGE_CACHE_MEMORY_MB = float(os.getenv("IMAGE_CACHE_MEMORY_MB", "64"))
+# 发送给Vision API的图片字节预算，在质量范围内取不超过预算的最高质量
+IMAGE_TARGET_BYTES = int(os.getenv("IMAGE_TARGET_KB", "300")) * 1024
+IMAGE_MIN_QUALITY = int(os.getenv("IMAGE_MIN_QUALITY", "40"))
+IMAGE_MAX_QUALITY = int(os.getenv("IMAGE_MAX_QUALITY", "85"))
+
+class DerivedImageCache:
+    """
+    图片预处理结果缓存
+    以原图内容的哈希和目标尺寸为键，同一张图片只需缩放压缩一次；
+    原图被删除时通过invalidate清除对应的缓存
+    """
+
+    def __init__(self, cache_dir, max_memory_bytes):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # 原图路径 -> (修改时间, 文件大小, 内容哈希)，避免每次都重新计算哈希
+        self._sources = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash_file(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def content_hash(self, path):
+        """获取原图内容哈希，文件未变化时复用上次的结果"""
+        stat = os.stat(path)
+        with self._lock:
+            known = self._sources.get(path)
+        if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2]
+        content_hash = self.hash_file(path)
+        with self._lock:
+            self._sources[path] = (stat.st_mtime_ns, stat.st_size, content_hash)
+        return content_hash
+
+    def remember(self, path, content_hash):
+        """记录已知的原图内容哈希（如上传时边写边算的结果），省去再次读取文件"""
+        stat = os.stat(path)
+        with self._lock:
+            self._sources[path] = (stat.st_mtime_ns, stat.st_size, content_hash)
+
+    def make_key(self, path, max_size):
+        # 字节预算不同，压缩结果也不同
+        return f"{self.content_hash(path)}_{max_size}_{IMAGE_TARGET_BYTES // 1024}k"
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.jpg")
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                value = base64.b64encode(f.read()).decode('utf-8')
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self._put_memory(key, value)
+        return value
+
+    def put(self, key, image_bytes, base64_image):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # 先写临时文件再重命名，避免其他进程读到不完整的文件
+        tmp_path = f"{self._disk_path(key)}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, self._disk_path(key))
+        self._put_memory(key, base64_image)
+
+    def _put_memory(self, key, value):
+        if len(value) > self.max_memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            self._memory[key] = value
+            self._memory_bytes += len(value)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def invalidate(self, path, content_hash=None):
+        """原图删除后清除其所有尺寸的缓存"""
+        with self._lock:
+            known = self._sources.pop(path, None)
+        content_hash = content_hash or (known[2] if known else None)
+        if not content_hash:
+            return
+        prefix = f"{content_hash}_"
+        with self._lock:
+            for key in [k for k in self._memory if k.startswith(prefix)]:
+                self._memory_bytes -= len(self._memory.pop(key))
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except FileNotFoundError:
+                        pass
+        logger.info(f"已清除图片缓存: {path}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'memory_entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0
+            }
+
+image_cache = DerivedImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MEMORY_MB * 1024 * 1024)
+
+# 图片预处理：缩放并压缩为JPEG
+def flatten_to_rgb(img):
+    """将图片转换为RGB，透明区域以白色背景填充"""
+    if img.mode == 'P' and 'transparency' in img.info:
+        img = img.convert('RGBA')
+    if img.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB') if img.mode != 'RGB' else img
+
+def encode_jpeg_within_budget(img, target_bytes=IMAGE_TARGET_BYTES,
+                              min_quality=IMAGE_MIN_QUALITY, max_quality=IMAGE_MAX_QUALITY):
+    """
+    在内存中二分查找不超过目标大小的最高JPEG质量
+    最高质量已满足时只编码一次；最低质量仍超出时返回最低质量的结果
+    :return: (JPEG字节数据, 使用的质量)
+    """
+    def encode(quality):
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+    best = encode(max_quality)
+    if target_bytes <= 0 or len(best) <= target_bytes:
+        return best, max_quality
+    best_quality = min_quality
+    best = encode(min_quality)
+    if len(best) > target_bytes:
+        return best, min_quality
+    low, high = min_quality + 1, max_quality - 1
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode(quality)
+        if len(data) <= target_bytes:
+            best, best_quality = data, quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best, best_quality
+
+def process_image(image_path, max_size=1024, target_bytes=IMAGE_TARGET_BYTES):
+    """
+    将图片缩放到max_size以内并按字节预算压缩为JPEG
+    JPEG在解码阶段通过draft()按DCT缩放，其他格式先用reduce()整数倍缩小，
+    最后再用LANCZOS精确缩放到目标尺寸
+    该函数会在预处理进程池中执行，只依赖Pillow
+    :return: JPEG字节数据
+    """
+    with Image.open(image_path) as img:
+        # 检查图片格式
+        logger.info(f"图片格式: {img.format}, 模式: {img.mode}")
+        
+        # 记录原始尺寸
+        original_width, original_height = img.size
+        logger.info(f"原始图片尺寸: {original_width}x{original_height}")
+        
+        # 计算缩放后的尺寸
+        scale_ratio = min(max_size / max(original_width, original_height), 1)
+        new_width = max(math.floor(original_width * scale_ratio), 1)
+        new_height = max(math.floor(original_height * scale_ratio), 1)
+        
+        if scale_ratio < 1 and img.format == 'JPEG':
+            # 解码时直接得到不小于目标尺寸的缩小图，省去全尺寸解码
+            img.draft('RGB', (new_width, new_height))
+        img = flatten_to_rgb(img)
+        
+        if scale_ratio < 1:
+            factor = min(img.width // new_width, img.height // new_height)
+            if factor >= 2:
+                img = img.reduce(factor)
+            logger.info(f"压缩图片至: {new_width}x{new_height}")
+            img = img.resize((new_width, new_height), Image.LANCZOS)
+        
+        image_bytes, quality = encode_jpeg_within_budget(img, target_bytes)
+        logger.info(f"压缩后图片大小: {len(image_bytes)/1024:.2f} KB，质量: {quality}")
+        return image_bytes
+
+# 上传后在进程池中预处理图片，绕过GIL，聊天时直接使用预处理结果
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", str(max((os.cpu_count() or 2) // 2, 1))))
+IMAGE_PREPROCESS_WAIT_TIMEOUT = float(os.getenv("IMAGE_PREPROCESS_WAIT_TIMEOUT", "30"))
+
+_preprocess_executor = None
+# 缓存键 -> 进行中的预处理任务
+_pending_preprocess = {}
+_preprocess_lock = threading.Lock()
+
+def get_preprocess_executor():
+    """获取图片预处理进程池，首次调用时创建"""
+    global _preprocess_executor
+    if _preprocess_executor is None:
+        with _init_lock:
+            if _preprocess_executor is None:
+                # 使用spawn启动子进程，避免fork继承线程锁和连接
+                _preprocess_executor = ProcessPoolExecutor(
+                    max_workers=IMAGE_PREPROCESS_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                logger.info(f"图片预处理进程池已创建，进程数: {IMAGE_PREPROCESS_WORKERS}")
+    return _preprocess_executor
+
+def schedule_image_preprocess(image_path, max_size=1024):
+    """
+    将图片预处理任务提交到进程池，结果写入图片缓存
+    :return: 缓存键
+    """
+    cache_key = image_cache.make_key(image_path, max_size)
+    with _preprocess_lock:
+        if cache_key in _pending_preprocess:
+            return cache_key
+    if image_cache.get(cache_key) is not None:
+        return cache_key
+    
+    future = get_preprocess_executor().submit(process_image, image_path, max_size)
+    with _preprocess_lock:
+        _pending_preprocess[cache_key] = future
+    
+    def on_done(done_future):
+        try:
+            image_bytes = done_future.result()
+            image_cache.put(cache_key, image_bytes, base64.b64encode(image_bytes).decode('utf-8'))
+            logger.info(f"图片预处理完成: {image_path}")
+        except Exception as e:
+            logger.error(f"图片预处理失败: {image_path}, {str(e)}")
+        finally:
+            with _preprocess_lock:
+                _pending_preprocess.pop(cache_key, None)
+    
+    future.add_done_callback(on_done)
+    return cache_key
+
+def wait_image_preprocess(cache_key):
+    """等待进行中的预处理任务，返回base64编码结果；没有任务或任务失败时返回None"""
+    with _preprocess_lock:
+        future = _pending_preprocess.get(cache_key)
+    if future is None:
+        return None
+    try:
+        start_time = time.time()
+        image_bytes = future.result(timeout=IMAGE_PREPROCESS_WAIT_TIMEOUT)
+        logger.info(f"等待图片预处理完成，耗时: {time.time() - start_time:.2f}秒")
+        return base64.b64encode(image_bytes).decode('utf-8')
+    except Exception as e:
+        logger.warning(f"等待图片预处理失败，改为直接处理: {str(e)}")
+        return None
+
 # 辅助函数：编码图片为base64
 def encode_image(image_path, max_size=1024):
     """将图片编码为base64格式，并进行适当压缩"""
     try:
         if not os.path.exists(image_path):
             logger.error(f"图片文件不存在: {image_path}")
+            image_cache.invalidate(image_path)
             raise FileNotFoundError(f"图片文件不存在: {image_path}")
             
         file_size = os.path.getsize(image_path)
@@ -1186,63 +3605,25 @@ def encode_image(image_path, max_size=1024):
             logger.error(f"图片文件过大: {file_size} bytes")
             raise ValueError(f"图片文件过大，大小: {file_size} bytes")
         
+        # 同一张图片以相同尺寸处理过时直接使用缓存
+        cache_key = image_cache.make_key(image_path, max_size)
+        cached_image = image_cache.get(cache_key)
+        if cached_image is not None:
+            logger.info(f"命中图片缓存: {cache_key}")
+            return cached_image
+        
+        # 上传时提交的预处理任务尚未完成，等待其结果
+        preprocessed_image = wait_image_preprocess(cache_key)
+        if preprocessed_image is not None:
+            return preprocessed_image
+        
         # 使用PIL库压缩图片
         try:
-            with Image.open(image_path) as img:
-                # 检查图片格式
-                logger.info(f"图片格式: {img.format}, 模式: {img.mode}")
-                
-                # 记录原始尺寸
-                original_width, original_height = img.size
-                logger.info(f"原始图片尺寸: {original_width}x{original_height}")
-                
-                # 计算缩放比例
-                if max(original_width, original_height) > max_size:
-                    scale_ratio = max_size / max(original_width, original_height)
-                    new_width = math.floor(original_width * scale_ratio)
-                    new_height = math.floor(original_height * scale_ratio)
-                    logger.info(f"压缩图片至: {new_width}x{new_height}")
-                    
-                    try:
-                        img = img.resize((new_width, new_height), Image.LANCZOS)
-                    except Exception as resize_error:
-                        logger.warning(f"使用LANCZOS调整大小失败，尝试使用BICUBIC: {str(resize_error)}")
-                        img = img.resize((new_width, new_height), Image.BICUBIC)
-                
-                # 将图片转换为JPEG格式并压缩
-                buffer = BytesIO()
-                
-                # 不同格式的图片需要不同的处理
-                if img.mode == 'RGBA':
-                    # RGBA模式（带透明通道）转换为RGB
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    background.paste(img, mask=img.split()[3])  # 使用alpha通道作为mask
-                    background.save(buffer, format="JPEG", quality=85)
-                else:
-                    # 其他模式直接转换和保存
-                    img.convert('RGB').save(buffer, format="JPEG", quality=85)
-                    
-                buffer.seek(0)
-                image_bytes = buffer.read()
-                
-                # 检查压缩后的大小
-                compressed_size = len(image_bytes)
-                logger.info(f"压缩后图片大小: {compressed_size/1024:.2f} KB")
-                
-                # 如果仍然太大，再次压缩
-                if compressed_size > 4 * 1024 * 1024:  # 如果超过4MB
-                    logger.warning(f"压缩后图片仍然过大: {compressed_size} bytes，进行二次压缩")
-                    buffer = BytesIO()
-                    with Image.open(BytesIO(image_bytes)) as img2:
-                        # 降低质量继续压缩
-                        img2.save(buffer, format="JPEG", quality=65)
-                    buffer.seek(0)
-                    image_bytes = buffer.read()
-                    logger.info(f"二次压缩后大小: {len(image_bytes)/1024:.2f} KB")
-                
-                base64_image = base64.b64encode(image_bytes).decode('utf-8')
-                logger.info(f"图片编码后大小: {len(base64_image)/1024:.2f} KB")
-                return base64_image
+            image_bytes = process_image(image_path, max_size)
+            base64_image = base64.b64encode(image_bytes).decode('utf-8')
+            logger.info(f"图片编码后大小: {len(base64_image)/1024:.2f} KB")
+            image_cache.put(cache_key, image_bytes, base64_image)
+            return base64_image
         except UnboundLocalError as ule:
             logger.error(f"图片处理过程中出现未绑定局部变量错误: {str(ule)}")
             raise ValueError(f"图片处理错误: {str(ule)}")
@@ -1254,72 +3635,90 @@ def encode_image(image_path, max_size=1024):
         logger.error(f"错误详情: {traceback.format_exc()}")
         raise ValueError(f"图片编码失败: {str(e)}")
 
-def get_vision_response(image_path, user_message=""):
-    """使用Vision API处理图片"""
+def build_vision_messages(image_path, user_message=""):
+    """
+    构建Vision API请求消息
+    :param image_path: 图片路径（相对或绝对）
+    :param user_message: 用户提问
+    :return: (消息数组, 错误信息)，成功时错误信息为None
+    """
+    # 确保图片路径处理正确
+    if not image_path.startswith('/'):
+        # 相对路径，转换为绝对路径
+        abs_path = os.path.join(app.root_path, image_path)
+    else:
+        # 已经是绝对路径
+        abs_path = image_path
+        
+    logger.info(f"转换后的绝对路径: {abs_path}")
+    
+    # 检查文件是否存在
+    if not os.path.exists(abs_path):
+        logger.error(f"图片文件不存在: {abs_path}")
+        return None, f"图片文件不存在: {abs_path}，请重新上传"
+        
+    # 检查API密钥是否有效
+    if not api_key:
+        logger.error("OpenAI API密钥未设置")
+        return None, "系统配置错误: API密钥未设置"
+    
+    # 读取并编码图片，压缩至1024像素以减少数据量
+    try:
+        base64_image = encode_image(abs_path, max_size=1024)
+        logger.info("图片编码成功")
+        logger.debug(f"编码后图片大小: {len(base64_image)} bytes")
+    except Exception as encode_error:
+        logger.error(f"图片编码失败: {str(encode_error)}")
+        return None, f"图片编码失败: {str(encode_error)}"
+    
+    # 构建消息，简化请求格式
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": user_message if user_message else "这张图片里面有什么"},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{base64_image}"
+                    }
+                }
+            ]
+        }
+    ]
+    return messages, None
+
+def get_vision_response(image_path, user_message="", user_id=None):
+    """
+    使用Vision API处理图片
+    :param user_id: 用户ID，提供时将上游实际用量记入用户token用量
+    """
     try:
         logger.info(f"开始处理图片: {image_path}")
         
-        # 确保图片路径处理正确
-        if not image_path.startswith('/'):
-            # 相对路径，转换为绝对路径
-            abs_path = os.path.join(app.root_path, image_path)
-        else:
-            # 已经是绝对路径
-            abs_path = image_path
-            
-        logger.info(f"转换后的绝对路径: {abs_path}")
-        
-        # 检查文件是否存在
-        if not os.path.exists(abs_path):
-            logger.error(f"图片文件不存在: {abs_path}")
-            return f"图片文件不存在: {abs_path}，请重新上传"
-            
-        # 检查API密钥是否有效
-        if not api_key:
-            logger.error("OpenAI API密钥未设置")
-            return "系统配置错误: API密钥未设置"
-        
-        # 读取并编码图片，压缩至1024像素以减少数据量
-        try:
-            base64_image = encode_image(abs_path, max_size=1024)
-            logger.info("图片编码成功")
-            logger.debug(f"编码后图片大小: {len(base64_image)} bytes")
-        except Exception as encode_error:
-            logger.error(f"图片编码失败: {str(encode_error)}")
-            return f"图片编码失败: {str(encode_error)}"
-        
-        # 构建消息，简化请求格式
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": user_message if user_message else "这张图片里面有什么"},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
-            }
-        ]
+        messages, error_msg = build_vision_messages(image_path, user_message)
+        if error_msg:
+            return error_msg
         
         logger.info("准备调用Vision API")
         # 记录完整请求信息用于调试
         logger.debug(f"API请求URL: {api_base}")
-        logger.debug(f"API请求模型: gpt-4o")
+        logger.debug(f"API请求模型: {VISION_MODEL}")
         
         try:
             # 简化API调用，移除复杂的重试逻辑
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                max_tokens=500,
-                timeout=60
-            )
+            with upstream_limiter:
+                response = get_openai_client().chat.completions.create(
+                    model=VISION_MODEL,
+                    messages=messages,
+                    max_tokens=500,
+                    timeout=60
+                )
             
             logger.info("Vision API调用成功")
             answer = response.choices[0].message.content
+            if user_id:
+                record_response_usage(user_id, response, count_tokens(user_message) + 500, answer)
             logger.info(f"成功获取图片描述，长度: {len(answer)}")
             return answer
                 
@@ -1332,6 +3731,356 @@ def get_vision_response(image_path, user_message=""):
         logger.error(f"错误详情: {traceback.format_exc()}")
         return f"处理图片时发生错误: {str(e)}"
 
+def stream_vision_response(image_path, user_message="", user_id=None):
+    """
+    以流式方式使用Vision API处理图片
+    :param user_id: 用户ID，提供时将上游实际用量记入用户token用量
+    :return: 生成器，依次产出 ('delta', 文本片段)，最后产出 ('usage', token用量字典)
+    """
+    logger.info(f"开始处理图片（流式）: {image_path}")
+    answer_parts = []
+    usage = None
+    try:
+        messages, error_msg = build_vision_messages(image_path, user_message)
+        if error_msg:
+            answer_parts.append(error_msg)
+            yield 'delta', error_msg
+        else:
+            start_time = time.time()
+            with upstream_limiter:
+                stream = get_openai_client().chat.completions.create(
+                    model=VISION_MODEL,
+                    messages=messages,
+                    max_tokens=500,
+                    timeout=60,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                )
+                for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not answer_parts:
+                            logger.info(f"Vision API首个token耗时: {time.time() - start_time:.2f}秒")
+                        answer_parts.append(delta)
+                        yield 'delta', delta
+            logger.info(f"Vision API流式调用完成，耗时: {time.time() - start_time:.2f}秒")
+    except Exception as e:
+        logger.error(f"Vision API流式调用失败: {str(e)}")
+        error_msg = f"处理图片时发生错误: {str(e)}"
+        answer_parts.append(error_msg)
+        yield 'delta', error_msg
+    
+    if usage:
+        if user_id:
+            usage_ledger.record(user_id, usage.prompt_tokens, usage.completion_tokens)
+        yield 'usage', {
+            'prompt_tokens': usage.prompt_tokens,
+            'completion_tokens': usage.completion_tokens,
+            'total_tokens': usage.total_tokens
+        }
+    else:
+        # 用户文本token + 预估图片token
+        prompt_tokens = (count_tokens(user_message) if user_message else 0) + 500
+        completion_tokens = count_tokens(''.join(answer_parts))
+        if user_id:
+            usage_ledger.record(user_id, prompt_tokens, completion_tokens)
+        yield 'usage', {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+
+class UploadTooLargeError(Exception):
+    """上传文件超过大小限制"""
+
+    def __init__(self, limit):
+        super().__init__(f"文件超过 {limit} bytes")
+        self.limit = limit
+
+# 上传文件按内容寻址存储：文件名为内容sha256加扩展名，相同内容只保存一份
+UPLOAD_BLOB_PATTERN = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+
+def upload_blob_name(content_hash, filename):
+    """根据内容哈希和原始文件名生成存储文件名"""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'bin'
+    if ext == 'jpeg':
+        ext = 'jpg'
+    return f"{content_hash}.{ext}"
+
+# 分块保存上传文件
+def save_upload_stream(file, upload_path, filename, max_size=MAX_FILE_SIZE):
+    """
+    将上传文件分块写入上传目录下的临时文件，边写边累计大小和sha256，
+    完成后按内容哈希命名；相同内容的文件已存在时直接复用并删除临时文件，
+    超过大小限制或出错时同样删除临时文件
+    :param file: werkzeug FileStorage
+    :param upload_path: 上传目录
+    :param filename: 安全处理后的原始文件名，用于确定扩展名
+    :param max_size: 允许的最大字节数
+    :return: (存储文件名, 文件大小, sha256十六进制, 是否复用已有文件)
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(prefix='.upload-', suffix='.part', dir=upload_path)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLargeError(max_size)
+                digest.update(chunk)
+                out.write(chunk)
+        content_hash = digest.hexdigest()
+        blob_name = upload_blob_name(content_hash, filename)
+        blob_path = os.path.join(upload_path, blob_name)
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+            # 刷新修改时间，保留策略据此判断文件仍在使用
+            os.utime(blob_path)
+            return blob_name, size, content_hash, True
+        # mkstemp创建的文件权限为0600，静态文件服务需要可读
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, blob_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return blob_name, size, content_hash, False
+
+def record_user_upload(user_id, content_hash, stored_name, original_name, file_size):
+    """记录用户对上传文件的引用，同一用户重复上传同一内容只保留一条记录"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO user_uploads (user_id, content_hash, stored_name, original_name, file_size)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE original_name = VALUES(original_name), last_used_at = CURRENT_TIMESTAMP
+        ''', (user_id, content_hash, stored_name, original_name, file_size))
+        conn.commit()
+    finally:
+        conn.close()
+
+# 上传文件保留策略：
+# 未关联到任何有效对话的上传超过宽限期后删除；
+# 长期未使用的图片移入压缩归档目录，再次使用时自动恢复；
+# 设置了保留天数时，超过保留期的图片（包括归档）直接删除
+UPLOAD_ARCHIVE_DIR = os.getenv("UPLOAD_ARCHIVE_DIR", os.path.join(app.root_path, 'upload_archive'))
+UPLOAD_SWEEP_INTERVAL = int(os.getenv("UPLOAD_SWEEP_INTERVAL", "3600"))  # 秒，0表示不启动后台清理
+UPLOAD_ORPHAN_GRACE_HOURS = float(os.getenv("UPLOAD_ORPHAN_GRACE_HOURS", "24"))
+UPLOAD_ARCHIVE_AFTER_DAYS = float(os.getenv("UPLOAD_ARCHIVE_AFTER_DAYS", "30"))  # 0表示不归档
+UPLOAD_RETENTION_DAYS = float(os.getenv("UPLOAD_RETENTION_DAYS", "0"))  # 0表示永久保留
+
+def upload_content_hash(image_path):
+    """从按内容寻址的上传文件路径中取出内容哈希，旧格式文件名返回None"""
+    name = os.path.basename(image_path)
+    if not UPLOAD_BLOB_PATTERN.match(name):
+        return None
+    return name.split('.', 1)[0]
+
+def link_chat_upload(user_id, chat_id, image_path):
+    """记录图片被哪个对话使用，并刷新用户上传记录的最近使用时间"""
+    content_hash = upload_content_hash(image_path)
+    if not content_hash or not chat_id:
+        return
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT IGNORE INTO chat_uploads (chat_history_id, user_id, content_hash)
+            VALUES (%s, %s, %s)
+        ''', (chat_id, user_id, content_hash))
+        cursor.execute('''
+            UPDATE user_uploads SET last_used_at = CURRENT_TIMESTAMP
+            WHERE user_id = %s AND content_hash = %s
+        ''', (user_id, content_hash))
+        conn.commit()
+    finally:
+        conn.close()
+
+def record_chat_upload(user_id, chat_id, image_path):
+    """关联图片与对话，失败只记录日志，不影响聊天响应"""
+    try:
+        link_chat_upload(user_id, chat_id, image_path)
+    except Exception as e:
+        logger.warning(f"记录对话图片失败: {str(e)}")
+
+def archive_path_for(file_path):
+    return os.path.join(UPLOAD_ARCHIVE_DIR, os.path.basename(file_path) + '.gz')
+
+def archive_upload(file_path):
+    """将上传文件压缩移入归档目录"""
+    os.makedirs(UPLOAD_ARCHIVE_DIR, exist_ok=True)
+    target = archive_path_for(file_path)
+    fd, temp_path = tempfile.mkstemp(prefix='.archive-', suffix='.part', dir=UPLOAD_ARCHIVE_DIR)
+    try:
+        with open(file_path, 'rb') as src, os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(filename=os.path.basename(file_path), mode='wb', fileobj=raw) as dst:
+                shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+        os.replace(temp_path, target)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    os.remove(file_path)
+
+def restore_archived_upload(file_path):
+    """
+    确保上传文件可用：文件已被归档时解压恢复到上传目录
+    :return: 文件是否可用
+    """
+    if os.path.exists(file_path):
+        return True
+    source = archive_path_for(file_path)
+    if not os.path.exists(source):
+        return False
+    fd, temp_path = tempfile.mkstemp(prefix='.upload-', suffix='.part', dir=os.path.dirname(file_path))
+    try:
+        with gzip.open(source, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    os.remove(source)
+    logger.info(f"已从归档恢复上传文件: {file_path}")
+    return True
+
+def _to_epoch(value):
+    return value.timestamp() if value else 0
+
+def sweep_uploads(now=None):
+    """
+    按保留策略清理上传文件，返回本次清理的统计
+    多个进程同时运行时，通过MySQL命名锁保证同一时刻只有一个进程在清理
+    """
+    now = now or time.time()
+    result = {'scanned': 0, 'deleted': 0, 'archived': 0, 'freed_bytes': 0, 'skipped': False}
+    upload_path = os.path.join(app.root_path, UPLOAD_FOLDER)
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT GET_LOCK('upload_sweep', 0)")
+        if cursor.fetchone()[0] != 1:
+            result['skipped'] = True
+            return result
+        try:
+            # 每个内容哈希最近一次被用户上传/使用的时间
+            cursor.execute("SELECT content_hash, MAX(last_used_at) FROM user_uploads GROUP BY content_hash")
+            last_uploaded = {row[0]: _to_epoch(row[1]) for row in cursor.fetchall()}
+            # 仍被有效对话引用的图片，以对话最近更新时间为准
+            cursor.execute('''
+                SELECT cu.content_hash, MAX(ch.updated_at)
+                FROM chat_uploads cu JOIN chat_histories ch ON ch.id = cu.chat_history_id
+                WHERE ch.is_active = 1
+                GROUP BY cu.content_hash
+            ''')
+            last_chat_use = {row[0]: _to_epoch(row[1]) for row in cursor.fetchall()}
+            
+            blobs = {}
+            for directory, suffix in ((upload_path, ''), (UPLOAD_ARCHIVE_DIR, '.gz')):
+                if not os.path.isdir(directory):
+                    continue
+                for entry in os.scandir(directory):
+                    name = entry.name[:-len(suffix)] if suffix and entry.name.endswith(suffix) else entry.name
+                    if entry.is_file() and UPLOAD_BLOB_PATTERN.match(name):
+                        blobs.setdefault(name, []).append((entry.path, entry.stat()))
+            
+            expired_hashes = []
+            for name, copies in blobs.items():
+                result['scanned'] += 1
+                content_hash = name.split('.', 1)[0]
+                file_path = os.path.join(upload_path, name)
+                newest_mtime = max(stat.st_mtime for _, stat in copies)
+                last_used = max(last_uploaded.get(content_hash, 0), last_chat_use.get(content_hash, 0), newest_mtime)
+                idle_seconds = now - last_used
+                
+                if content_hash not in last_chat_use:
+                    expired = idle_seconds > UPLOAD_ORPHAN_GRACE_HOURS * 3600
+                else:
+                    expired = UPLOAD_RETENTION_DAYS > 0 and idle_seconds > UPLOAD_RETENTION_DAYS * 86400
+                
+                if expired:
+                    for path, stat in copies:
+                        try:
+                            os.remove(path)
+                            result['freed_bytes'] += stat.st_size
+                        except FileNotFoundError:
+                            pass
+                    image_cache.invalidate(file_path, content_hash)
+                    expired_hashes.append(content_hash)
+                    result['deleted'] += 1
+                elif (UPLOAD_ARCHIVE_AFTER_DAYS > 0 and idle_seconds > UPLOAD_ARCHIVE_AFTER_DAYS * 86400
+                        and os.path.exists(file_path)):
+                    size = os.path.getsize(file_path)
+                    archive_upload(file_path)
+                    image_cache.invalidate(file_path, content_hash)
+                    result['archived'] += 1
+                    result['freed_bytes'] += size
+            
+            # 文件已删除的引用记录一并清除
+            for start in range(0, len(expired_hashes), 500):
+                batch = expired_hashes[start:start + 500]
+                placeholders = ', '.join(['%s'] * len(batch))
+                cursor.execute(f"DELETE FROM user_uploads WHERE content_hash IN ({placeholders})", batch)
+                cursor.execute(f"DELETE FROM chat_uploads WHERE content_hash IN ({placeholders})", batch)
+            conn.commit()
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('upload_sweep')")
+            cursor.fetchone()
+    finally:
+        conn.close()
+    logger.info(f"上传文件清理完成: 扫描 {result['scanned']} 个，删除 {result['deleted']} 个，"
+                f"归档 {result['archived']} 个，释放 {result['freed_bytes']} bytes")
+    return result
+
+# 后台清理线程状态，供/metrics查看
+upload_sweeper_state = {'running': False, 'last_run': None, 'last_result': None, 'last_error': None}
+
+def start_upload_sweeper(interval=UPLOAD_SWEEP_INTERVAL):
+    """启动后台上传文件清理线程，每个进程只启动一次"""
+    if interval <= 0:
+        return
+    with _init_lock:
+        if upload_sweeper_state['running']:
+            return
+        upload_sweeper_state['running'] = True
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                upload_sweeper_state['last_result'] = sweep_uploads()
+                upload_sweeper_state['last_error'] = None
+            except Exception as e:
+                upload_sweeper_state['last_error'] = str(e)
+                logger.error(f"上传文件清理失败: {str(e)}")
+            upload_sweeper_state['last_run'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    threading.Thread(target=run, name='upload-sweeper', daemon=True).start()
+    logger.info(f"上传文件清理线程已启动，间隔: {interval}秒")
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    """请求体超过MAX_CONTENT_LENGTH"""
+    logger.warning(f"请求体过大: {request.path}")
+    return jsonify({
+        'success': False,
+        'message': f'文件大小不能超过 {MAX_FILE_SIZE/1024/1024}MB'
+    }), 413
+
 @app.route('/upload-image', methods=['POST'])
 def upload_image():
     """处理图片上传"""
@@ -1361,43 +4110,45 @@ def upload_image():
                 'message': f'只支持以下格式: {", ".join(ALLOWED_EXTENSIONS)}'
             }), 400
         
-        # 检查文件大小
-        file_content = file.read()
-        file.seek(0)  # 重置文件指针
-        content_length = len(file_content)
-        logger.info(f"文件大小: {content_length} bytes")
-        
-        if content_length > MAX_FILE_SIZE:
-            logger.warning(f"文件过大: {content_length} bytes")
-            return jsonify({
-                'success': False,
-                'message': f'文件大小不能超过 {MAX_FILE_SIZE/1024/1024}MB'
-            }), 400
-        
         # 确保上传目录存在
         upload_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
         os.makedirs(upload_path, exist_ok=True)
         
-        # 生成安全的文件名
         filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        file_path = os.path.join(upload_path, unique_filename)
-        
-        logger.info(f"准备保存文件到: {file_path}")
         
-        # 保存文件
+        # 分块保存文件，边写边检查大小并计算哈希，相同内容只存一份
         try:
-            file.save(file_path)
-            if not os.path.exists(file_path):
-                raise FileNotFoundError("文件保存失败")
-            logger.info(f"文件成功保存: {file_path}")
+            stored_name, content_length, content_hash, reused = save_upload_stream(file, upload_path, filename)
+        except UploadTooLargeError as e:
+            logger.warning(f"文件过大: 已超过 {e.limit} bytes")
+            return jsonify({
+                'success': False,
+                'message': f'文件大小不能超过 {MAX_FILE_SIZE/1024/1024}MB'
+            }), 400
         except Exception as e:
             logger.error(f"文件保存失败: {str(e)}")
             return jsonify({'success': False, 'message': f'文件保存失败: {str(e)}'}), 500
+        file_path = os.path.join(upload_path, stored_name)
+        if reused:
+            logger.info(f"文件内容已存在，复用: {file_path}")
+        else:
+            logger.info(f"文件成功保存: {file_path}, 大小: {content_length} bytes")
+        image_cache.remember(file_path, content_hash)
+        
+        try:
+            record_user_upload(session['user_id'], content_hash, stored_name, filename, content_length)
+        except Exception as e:
+            logger.error(f"记录上传文件失败: {str(e)}")
+        
+        # 提交后台预处理，用户发送消息时即可直接使用处理结果
+        try:
+            schedule_image_preprocess(file_path)
+        except Exception as e:
+            logger.warning(f"提交图片预处理任务失败: {str(e)}")
         
         # 返回文件信息
-        relative_path = os.path.join('static', 'uploads', unique_filename)
-        file_url = url_for('static', filename=f'uploads/{unique_filename}')
+        relative_path = os.path.join('static', 'uploads', stored_name)
+        file_url = url_for('static', filename=f'uploads/{stored_name}')
         
         logger.info(f"文件上传成功: {file_url}")
         return jsonify({
@@ -1407,6 +4158,8 @@ def upload_image():
             'path': relative_path
         })
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         logger.error(f"文件上传失败: {str(e)}")
         return jsonify({'success': False, 'message': f'文件上传失败: {str(e)}'}), 500
@@ -1465,33 +4218,10 @@ def get_history():
         # 获取会话中的消息历史
         messages = session[user_messages_key]
         
-        # 计算token使用情况
-        # 提取文本消息以计算token
-        text_messages = []
-        for msg in messages:
-            # 确保每条消息都有role和content
-            if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
-                continue
-                
-            # 如果content是一个字符串，直接添加
-            if isinstance(msg['content'], str):
-                text_messages.append(msg)
-            # 如果content是一个列表（可能包含图片），提取文本部分
-            elif isinstance(msg['content'], list):
-                text_part = next((item for item in msg['content'] if item.get('type') == 'text'), None)
-                if text_part:
-                    # 创建一个新的消息对象，只包含文本内容
-                    text_messages.append({
-                        'role': msg['role'],
-                        'content': text_part.get('text', '')
-                    })
-        
-        # 计算用户消息和助手消息的token数
-        user_messages = [msg for msg in text_messages if msg['role'] == 'user']
-        user_tokens = sum(count_tokens(msg['content']) for msg in user_messages)
-        
-        assistant_messages = [msg for msg in text_messages if msg['role'] == 'assistant']
-        assistant_tokens = sum(count_tokens(msg['content']) for msg in assistant_messages)
+        # 计算token使用情况（使用每条消息缓存的token数）
+        token_count = summarize_token_count(messages)
+        user_tokens = token_count['user_tokens']
+        assistant_tokens = token_count['assistant_tokens']
         
         total_tokens = user_tokens + assistant_tokens
         
@@ -1550,8 +4280,17 @@ def get_user_chat_histories():
             
         user_id = session['user_id']
         
+        # 分页参数
+        limit = min(max(request.args.get('limit', CHAT_HISTORY_PAGE_SIZE, type=int), 1), CHAT_HISTORY_MAX_PAGE_SIZE)
+        before = None
+        if request.args.get('cursor'):
+            try:
+                before = decode_history_cursor(request.args['cursor'])
+            except ValueError:
+                return jsonify({'success': False, 'message': '无效的分页参数'}), 400
+        
         # 获取用户的聊天历史记录
-        histories = get_chat_histories(user_id)
+        histories, next_cursor = get_chat_histories(user_id, limit, before)
         
         # 格式化日期时间
         for history in histories:
@@ -1562,7 +4301,9 @@ def get_user_chat_histories():
         
         return jsonify({
             'success': True,
-            'histories': histories
+            'histories': histories,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
         })
     except Exception as e:
         logger.error(f"获取聊天历史记录失败: {str(e)}")
@@ -1578,63 +4319,32 @@ def get_history_chat(history_id):
             
         user_id = session['user_id']
         
-        # 检查聊天历史记录是否存在并属于当前用户
-        history = get_chat_history(history_id)
-        if not history:
-            return jsonify({'success': False, 'message': '未找到聊天历史记录'}), 404
-            
-        if history['user_id'] != user_id:
-            return jsonify({'success': False, 'message': '无权访问此聊天历史记录'}), 403
-        
-        # 从数据库加载会话数据
-        session_data = load_user_session(user_id, history_id)
+        # 消息窗口参数：默认加载最近的消息，before为上次返回的游标
+        limit = min(max(request.args.get('limit', CHAT_MESSAGE_WINDOW, type=int), 1), CHAT_MESSAGE_MAX_WINDOW)
+        before_seq = request.args.get('before', type=int)
         
+        # 在一个连接上完成归属检查并加载消息
+        session_data = load_owned_chat_window(user_id, history_id, limit, before_seq)
         if not session_data:
-            return jsonify({
-                'success': False,
-                'message': '未找到会话数据'
-            }), 404
-        
-        # 用户消息键
-        user_messages_key = f'messages_{user_id}'
+            return jsonify({'success': False, 'message': '未找到聊天历史记录'}), 404
+        history = session_data['history']
         
-        if user_messages_key not in session_data or not session_data[user_messages_key]:
+        if not session_data['messages']:
             return jsonify({
                 'success': True,
                 'messages': [],
-                'history': history
+                'history': history,
+                'has_more': False,
+                'before': None
             })
         
         # 处理消息内容，准备返回
-        messages = session_data[user_messages_key]
+        messages = session_data['messages']
         
-        # 计算token使用情况
-        # 提取文本消息以计算token
-        text_messages = []
-        for msg in messages:
-            # 确保每条消息都有role和content
-            if not isinstance(msg, dict) or 'role' not in msg or 'content' not in msg:
-                continue
-                
-            # 如果content是一个字符串，直接添加
-            if isinstance(msg['content'], str):
-                text_messages.append(msg)
-            # 如果content是一个列表（可能包含图片），提取文本部分
-            elif isinstance(msg['content'], list):
-                text_part = next((item for item in msg['content'] if item.get('type') == 'text'), None)
-                if text_part:
-                    # 创建一个新的消息对象，只包含文本内容
-                    text_messages.append({
-                        'role': msg['role'],
-                        'content': text_part.get('text', '')
-                    })
-        
-        # 计算用户消息和助手消息的token数
-        user_messages = [msg for msg in text_messages if msg['role'] == 'user']
-        user_tokens = sum(count_tokens(msg['content']) for msg in user_messages)
-        
-        assistant_messages = [msg for msg in text_messages if msg['role'] == 'assistant']
-        assistant_tokens = sum(count_tokens(msg['content']) for msg in assistant_messages)
+        # 整个会话的token使用情况
+        token_count = session_data['token_count']
+        user_tokens = token_count['user_tokens']
+        assistant_tokens = token_count['assistant_tokens']
         
         total_tokens = user_tokens + assistant_tokens
         
@@ -1670,7 +4380,9 @@ def get_history_chat(history_id):
                 'assistant_tokens': assistant_tokens,
                 'total': total_tokens,
                 'limit': USER_MAX_TOKENS
-            }
+            },
+            'has_more': session_data['has_more'],
+            'before': session_data['before']
         })
     except Exception as e:
         logger.error(f"获取聊天历史内容失败: {str(e)}")
@@ -1686,14 +4398,6 @@ def update_history_title(history_id):
             
         user_id = session['user_id']
         
-        # 检查聊天历史记录是否存在并属于当前用户
-        history = get_chat_history(history_id)
-        if not history:
-            return jsonify({'success': False, 'message': '未找到聊天历史记录'}), 404
-            
-        if history['user_id'] != user_id:
-            return jsonify({'success': False, 'message': '无权修改此聊天历史记录'}), 403
-        
         # 获取新标题
         data = request.get_json()
         if not data or 'title' not in data:
@@ -1703,8 +4407,8 @@ def update_history_title(history_id):
         if not new_title:
             return jsonify({'success': False, 'message': '标题不能为空'}), 400
         
-        # 更新标题
-        if update_chat_history_title(history_id, new_title):
+        # 更新标题（同时检查记录归属）
+        if update_chat_history_title(user_id, history_id, new_title):
             return jsonify({
                 'success': True,
                 'message': '标题已更新',
@@ -1712,7 +4416,7 @@ def update_history_title(history_id):
                 'new_title': new_title
             })
         else:
-            return jsonify({'success': False, 'message': '更新标题失败'}), 500
+            return jsonify({'success': False, 'message': '未找到聊天历史记录'}), 404
     except Exception as e:
         logger.error(f"更新聊天历史标题失败: {str(e)}")
         return jsonify({'success': False, 'message': f'服务器内部错误: {str(e)}'}), 500
@@ -1727,27 +4431,103 @@ def delete_history(history_id):
             
         user_id = session['user_id']
         
-        # 检查聊天历史记录是否存在并属于当前用户
-        history = get_chat_history(history_id)
-        if not history:
-            return jsonify({'success': False, 'message': '未找到聊天历史记录'}), 404
-            
-        if history['user_id'] != user_id:
-            return jsonify({'success': False, 'message': '无权删除此聊天历史记录'}), 403
-        
-        # 删除聊天历史记录
-        if delete_chat_history(history_id):
+        # 删除聊天历史记录（同时检查记录归属）
+        if delete_chat_history(user_id, history_id):
             return jsonify({
                 'success': True,
                 'message': '聊天历史记录已删除',
                 'history_id': history_id
             })
         else:
-            return jsonify({'success': False, 'message': '删除聊天历史记录失败'}), 500
+            return jsonify({'success': False, 'message': '未找到聊天历史记录'}), 404
     except Exception as e:
         logger.error(f"删除聊天历史记录失败: {str(e)}")
         return jsonify({'success': False, 'message': f'服务器内部错误: {str(e)}'}), 500
 
+# 回复缓存设置
+@app.route('/settings/response-cache', methods=['GET', 'PUT'])
+def response_cache_setting():
+    """查询或修改当前用户是否使用回复缓存"""
+    try:
+        if 'user_id' not in session:
+            return jsonify({'success': False, 'message': '请先登录'}), 401
+        
+        user_id = session['user_id']
+        
+        if request.method == 'GET':
+            return jsonify({'success': True, 'enabled': session.get('response_cache_enabled', True)})
+        
+        data = request.get_json()
+        if not data or 'enabled' not in data:
+            return jsonify({'success': False, 'message': '缺少enabled参数'}), 400
+        
+        enabled = bool(data['enabled'])
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET response_cache_enabled = %s WHERE id = %s', (int(enabled), user_id))
+        conn.commit()
+        cursor.close()
+        conn.close()
+        
+        session['response_cache_enabled'] = enabled
+        logger.info(f"用户 {user_id} {'启用' if enabled else '关闭'}了回复缓存")
+        return jsonify({'success': True, 'enabled': enabled})
+    except Exception as e:
+        logger.error(f"修改回复缓存设置失败: {str(e)}")
+        return jsonify({'success': False, 'message': f'服务器内部错误: {str(e)}'}), 500
+
+# 当前用户的token用量和额度
+@app.route('/usage', methods=['GET'])
+def get_usage():
+    """获取当前用户今日和本月的token用量"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'}), 401
+    totals = usage_ledger.usage(session['user_id'])
+    return jsonify({
+        'success': True,
+        'daily_tokens': totals['daily'],
+        'monthly_tokens': totals['monthly'],
+        'daily_quota': USER_DAILY_TOKEN_QUOTA,
+        'monthly_quota': USER_MONTHLY_TOKEN_QUOTA
+    })
+
+# 运行指标
+# 是否为管理员
+def is_admin(user_id):
+    """每次从数据库读取角色，角色变更后立即生效"""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT role FROM users WHERE id = %s AND is_active = 1", (user_id,))
+        row = cursor.fetchone()
+        return bool(row) and row[0] == 'admin'
+    finally:
+        conn.close()
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """获取服务运行指标（仅管理员）"""
+    if 'user_id' not in session:
+        return jsonify({'success': False, 'message': '请先登录'}), 401
+    try:
+        admin = is_admin(session['user_id'])
+    except Exception as e:
+        logger.error(f"查询用户角色失败: {str(e)}")
+        return jsonify({'success': False, 'message': '服务器内部错误'}), 500
+    if not admin:
+        return jsonify({'success': False, 'message': '无权访问'}), 403
+    return jsonify({
+        'success': True,
+        'token_cache': token_cache.stats(),
+        'upstream': upstream_limiter.stats(),
+        'response_cache': response_cache.stats(),
+        'image_cache': image_cache.stats(),
+        'upload_sweeper': upload_sweeper_state,
+        'usage_ledger': usage_ledger.stats(),
+        'db_pool': db_pool.stats() if db_pool else None,
+        'write_behind': write_behind.stats()
+    })
+
 # 创建新的聊天对话（开始新对话）
 @app.route('/new-chat', methods=['POST'])
 def new_chat():
@@ -1788,4 +4568,10 @@ if __name__ == '__main__':
     # 默认使用不同的端口，避免冲突
     port = 5000
     logger.info(f"Starting server on port {port}")
-    app.run(debug=True, port=port) 
\ No newline at end of file
+    if ASYNC_MODE:
+        # 协程模式使用gevent的WSGI服务器，每个请求一个greenlet
+        from gevent.pywsgi import WSGIServer
+        logger.info("以协程模式(gevent)启动")
+        WSGIServer(('127.0.0.1', port), create_app()).serve_forever()
+    else:
+        create_app().run(debug=True, port=port) 
\ No newline at end of file
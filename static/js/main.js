@@ -54,6 +54,8 @@ document.addEventListener('DOMContentLoaded', () => {
     let messageTimeout = null;  // 用于控制提示消息的显示时间
     let currentChatId = null;   // 当前聊天ID
     let chatHistories = [];     // 聊天历史记录列表
+    let historiesCursor = null; // 聊天历史列表下一页的游标
+    const MESSAGE_WINDOW = 50;  // 每次加载的历史消息条数
 
     // 当前请求的控制器
     let currentController = null;
@@ -124,6 +126,7 @@ document.addEventListener('DOMContentLoaded', () => {
         .then(data => {
             if (data.success) {
                 chatHistories = data.histories || [];
+                historiesCursor = data.next_cursor || null;
                 updateChatHistoryList();
                 
                 // 然后恢复当前会话
@@ -431,18 +434,16 @@ document.addEventListener('DOMContentLoaded', () => {
             }
             
             // 发送带图片路径的请求
-            fetch('/chat', {
+            const request = fetch('/chat/stream', {
                 method: 'POST',
                 body: formData,
                 credentials: 'same-origin',
                 signal: signal
-            })
-            .then(response => response.json())
-            .then(data => handleResponse(data, thinkingMessage))
-            .catch(error => handleFetchError(error, signal, thinkingMessage));
+            });
+            handleStreamResponse(request, thinkingMessage, signal);
         } else {
             // 没有图片，使用JSON发送纯文本请求
-            fetch('/chat', {
+            const request = fetch('/chat/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -453,13 +454,104 @@ document.addEventListener('DOMContentLoaded', () => {
                 }),
                 credentials: 'same-origin',
                 signal: signal
-            })
-            .then(response => response.json())
-            .then(data => handleResponse(data, thinkingMessage))
-            .catch(error => handleFetchError(error, signal, thinkingMessage));
+            });
+            handleStreamResponse(request, thinkingMessage, signal);
         }
     }
     
+    /**
+     * 处理流式(SSE)聊天响应，逐段渲染AI回复
+     * @param {Promise<Response>} request - fetch请求
+     * @param {HTMLElement} thinkingMessage - "正在思考"提示元素
+     * @param {AbortSignal} signal - 用于取消请求的信号
+     */
+    function handleStreamResponse(request, thinkingMessage, signal) {
+        request
+        .then(response => {
+            const contentType = response.headers.get('Content-Type') || '';
+            // 未进入流式模式（如未登录、参数错误），按普通JSON响应处理
+            if (!response.body || !contentType.includes('text/event-stream')) {
+                return response.json().then(data => handleResponse(data, thinkingMessage));
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder('utf-8');
+            let buffer = '';
+            let answer = '';
+            let textDiv = null;
+            
+            // 处理单个SSE事件
+            const processEvent = (rawEvent) => {
+                let eventType = 'message';
+                const dataLines = [];
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) {
+                        eventType = line.slice(6).trim();
+                    } else if (line.startsWith('data:')) {
+                        dataLines.push(line.slice(5).trim());
+                    }
+                });
+                if (!dataLines.length) return;
+                const data = JSON.parse(dataLines.join('\n'));
+                
+                if (eventType === 'delta') {
+                    answer += data.content;
+                    if (!textDiv) {
+                        // 收到首个片段时移除"正在思考"提示并创建回复消息
+                        removeThinkingMessages(thinkingMessage);
+                        const messageDiv = appendMessage('assistant', answer);
+                        textDiv = messageDiv.querySelector('.message-text');
+                    } else {
+                        textDiv.innerHTML = marked.parse(answer);
+                        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                    }
+                } else if (eventType === 'done') {
+                    data.streamed = textDiv !== null;
+                    handleResponse(data, thinkingMessage);
+                } else if (eventType === 'error') {
+                    handleResponse(data, thinkingMessage);
+                }
+            };
+            
+            const read = () => reader.read().then(({ done, value }) => {
+                if (done) {
+                    if (buffer.trim()) {
+                        processEvent(buffer);
+                    }
+                    return;
+                }
+                buffer += decoder.decode(value, { stream: true });
+                let boundary = buffer.indexOf('\n\n');
+                while (boundary !== -1) {
+                    processEvent(buffer.slice(0, boundary));
+                    buffer = buffer.slice(boundary + 2);
+                    boundary = buffer.indexOf('\n\n');
+                }
+                return read();
+            });
+            return read();
+        })
+        .catch(error => handleFetchError(error, signal, thinkingMessage));
+    }
+    
+    /**
+     * 移除"正在思考"提示
+     * @param {HTMLElement} thinkingMessage - "正在思考"提示元素
+     */
+    function removeThinkingMessages(thinkingMessage) {
+        if (thinkingMessage && thinkingMessage.parentNode) {
+            thinkingMessage.parentNode.removeChild(thinkingMessage);
+        }
+        
+        // 确保没有其他"AI正在思考"消息存在
+        const thinkingMessages = document.querySelectorAll('.message.system');
+        thinkingMessages.forEach(msg => {
+            if (msg.textContent.includes('AI正在思考')) {
+                msg.parentNode.removeChild(msg);
+            }
+        });
+    }
+    
     /**
      * 处理请求错误
      * @param {Error} error - 错误对象
@@ -525,21 +617,13 @@ document.addEventListener('DOMContentLoaded', () => {
      */
     function handleResponse(data, thinkingMessage) {
         // 移除"正在思考"提示
-        if (thinkingMessage && thinkingMessage.parentNode) {
-            thinkingMessage.parentNode.removeChild(thinkingMessage);
-        }
-        
-        // 确保没有其他"AI正在思考"消息存在
-        const thinkingMessages = document.querySelectorAll('.message.system');
-        thinkingMessages.forEach(msg => {
-            if (msg.textContent.includes('AI正在思考')) {
-                msg.parentNode.removeChild(msg);
-            }
-        });
+        removeThinkingMessages(thinkingMessage);
         
         if (data.success) {
-            // 添加AI回复
-            appendMessage('assistant', data.response);
+            // 添加AI回复（流式响应已在接收过程中渲染）
+            if (!data.streamed) {
+                appendMessage('assistant', data.response);
+            }
             
             // 更新token计数
             if (data.token_count) {
@@ -575,6 +659,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 .then(historyData => {
                     if (historyData.success) {
                         chatHistories = historyData.histories || [];
+                        historiesCursor = historyData.next_cursor || null;
                         updateChatHistoryList();
                         highlightCurrentChat();
                     }
@@ -630,8 +715,10 @@ document.addEventListener('DOMContentLoaded', () => {
      * @param {string} role - 消息角色（user/assistant/system）
      * @param {string} text - 消息文本
      * @param {string|null} imageSrc - 可选的图片源
+     * @param {Node|null} container - 添加到的容器，默认为消息区域并滚动到底部
+     * @returns {HTMLElement} - 消息元素
      */
-    function appendMessage(role, text, imageSrc = null) {
+    function appendMessage(role, text, imageSrc = null, container = null) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${role}`;
         
@@ -668,10 +755,16 @@ document.addEventListener('DOMContentLoaded', () => {
         }
         
         messageDiv.appendChild(contentDiv);
+        if (container) {
+            container.appendChild(messageDiv);
+            return messageDiv;
+        }
         messagesContainer.appendChild(messageDiv);
         
         // 滚动到底部
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        
+        return messageDiv;
     }
 
     /**
@@ -765,12 +858,17 @@ document.addEventListener('DOMContentLoaded', () => {
     /**
      * 添加系统消息
      * @param {string} text - 系统消息文本
+     * @param {Node|null} container - 添加到的容器，默认为消息区域并滚动到底部
      */
-    function appendSystemMessage(text) {
+    function appendSystemMessage(text, container = null) {
         const messageDiv = document.createElement('div');
         messageDiv.className = 'message system';
         // 使用Markdown渲染系统消息
         messageDiv.innerHTML = marked.parse(text);
+        if (container) {
+            container.appendChild(messageDiv);
+            return;
+        }
         messagesContainer.appendChild(messageDiv);
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
     }
@@ -981,6 +1079,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 .then(historyData => {
                     if (historyData.success) {
                         chatHistories = historyData.histories || [];
+                        historiesCursor = historyData.next_cursor || null;
                         updateChatHistoryList();
                         highlightCurrentChat();
                     }
@@ -1131,6 +1230,39 @@ document.addEventListener('DOMContentLoaded', () => {
             // 添加到列表
             conversationList.appendChild(historyItem);
         });
+        
+        // 还有更多历史记录时显示加载按钮
+        if (historiesCursor) {
+            const loadMoreButton = document.createElement('button');
+            loadMoreButton.className = 'load-more-button';
+            loadMoreButton.textContent = '加载更多';
+            loadMoreButton.addEventListener('click', loadMoreChatHistories);
+            conversationList.appendChild(loadMoreButton);
+        }
+    }
+
+    /**
+     * 加载下一页聊天历史记录
+     */
+    function loadMoreChatHistories() {
+        if (!historiesCursor) return;
+        
+        fetch(`/chat-histories?cursor=${encodeURIComponent(historiesCursor)}`, {
+            method: 'GET',
+            credentials: 'same-origin'
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                chatHistories = chatHistories.concat(data.histories || []);
+                historiesCursor = data.next_cursor || null;
+                updateChatHistoryList();
+                highlightCurrentChat();
+            }
+        })
+        .catch(error => {
+            console.error('Error loading more chat histories:', error);
+        });
     }
 
     /**
@@ -1151,6 +1283,123 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    /**
+     * 渲染历史消息
+     * @param {Array} messages - 按时间顺序排列的消息
+     * @param {Node|null} container - 添加到的容器，默认为消息区域
+     */
+    function renderHistoryMessages(messages, container = null) {
+        // 跟踪我们是否需要跳过下一条消息（处理图片消息时可能会出现重复）
+        let skipNext = false;
+        
+        // 遍历并添加到界面
+        messages.forEach((msg, index) => {
+            // 如果需要跳过这条消息
+            if (skipNext) {
+                skipNext = false;
+                return;
+            }
+            
+            if (msg.role === 'user') {
+                // 检查是否包含图片
+                let imageSrc = null;
+                let textContent = msg.content;
+                
+                // 如果内容是数组（可能包含图片）
+                if (Array.isArray(msg.content)) {
+                    // 提取文本内容
+                    const textPart = msg.content.find(part => part.type === 'text');
+                    textContent = textPart ? textPart.text : '';
+                    
+                    // 提取图片URL或路径
+                    const imagePart = msg.content.find(part => part.type === 'image_url' || part.type === 'image');
+                    if (imagePart) {
+                        if (imagePart.type === 'image_url' && imagePart.image_url) {
+                            imageSrc = imagePart.image_url.url;
+                        } else if (imagePart.type === 'image' && imagePart.image_path) {
+                            imageSrc = '/' + imagePart.image_path;
+                        }
+                    }
+                    
+                    // 检查下一条消息是否是同一个用户发送的消息（文本版本）
+                    if (index + 1 < messages.length && 
+                        messages[index + 1].role === 'user' && 
+                        typeof messages[index + 1].content === 'string') {
+                        // 标记跳过下一条消息，因为它只是为了兼容性而添加的文本版本
+                        skipNext = true;
+                    }
+                }
+                
+                // 决定是否显示这条消息
+                if (textContent || imageSrc) {
+                    appendMessage('user', textContent, imageSrc, container);
+                }
+            } else if (msg.role === 'assistant') {
+                appendMessage('assistant', msg.content, null, container);
+            } else if (msg.role === 'system') {
+                appendSystemMessage(msg.content, container);
+            }
+        });
+    }
+
+    /**
+     * 创建"加载更早的消息"按钮
+     * @param {number} historyId - 聊天历史记录ID
+     * @param {number} before - 已加载的最早消息序号，用作分页游标
+     * @returns {HTMLElement} - 按钮元素
+     */
+    function createLoadEarlierButton(historyId, before) {
+        const loadEarlierButton = document.createElement('button');
+        loadEarlierButton.className = 'load-more-button';
+        loadEarlierButton.textContent = '加载更早的消息';
+        loadEarlierButton.addEventListener('click', () => {
+            loadEarlierMessages(historyId, before, loadEarlierButton);
+        });
+        return loadEarlierButton;
+    }
+
+    /**
+     * 加载游标之前的一页消息并插入到已显示的消息前面
+     * @param {number} historyId - 聊天历史记录ID
+     * @param {number} before - 只加载序号小于该值的消息
+     * @param {HTMLElement} button - 被点击的加载按钮，加载完成后替换为新的消息
+     */
+    function loadEarlierMessages(historyId, before, button) {
+        button.disabled = true;
+        button.textContent = '正在加载...';
+        
+        fetch(`/chat-history/${historyId}?before=${before}&limit=${MESSAGE_WINDOW}`, {
+            method: 'GET',
+            credentials: 'same-origin'
+        })
+        .then(response => response.json())
+        .then(data => {
+            // 加载期间切换了对话时丢弃结果
+            if (historyId !== currentChatId || !button.isConnected) return;
+            if (!data.success) {
+                button.disabled = false;
+                button.textContent = '加载更早的消息';
+                return;
+            }
+            
+            const fragment = document.createDocumentFragment();
+            if (data.has_more && data.before !== null) {
+                fragment.appendChild(createLoadEarlierButton(historyId, data.before));
+            }
+            renderHistoryMessages(data.messages || [], fragment);
+            
+            // 保持当前可见的消息位置不变
+            const previousHeight = messagesContainer.scrollHeight;
+            button.replaceWith(fragment);
+            messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+        })
+        .catch(error => {
+            console.error('Error loading earlier messages:', error);
+            button.disabled = false;
+            button.textContent = '加载更早的消息';
+        });
+    }
+
     /**
      * 加载特定历史记录的聊天会话
      * @param {number} historyId - 聊天历史记录ID
@@ -1166,7 +1415,7 @@ document.addEventListener('DOMContentLoaded', () => {
         appendSystemMessage('正在加载聊天历史...');
         
         // 获取历史聊天记录
-        fetch(`/chat-history/${historyId}`, {
+        fetch(`/chat-history/${historyId}?limit=${MESSAGE_WINDOW}`, {
             method: 'GET',
             credentials: 'same-origin'
         })
@@ -1182,57 +1431,12 @@ document.addEventListener('DOMContentLoaded', () => {
                 
                 // 如果有历史消息
                 if (data.messages && data.messages.length > 0) {
-                    // 跟踪我们是否需要跳过下一条消息（处理图片消息时可能会出现重复）
-                    let skipNext = false;
+                    // 还有更早的消息时显示加载按钮
+                    if (data.has_more && data.before !== null) {
+                        messagesContainer.appendChild(createLoadEarlierButton(historyId, data.before));
+                    }
                     
-                    // 遍历并添加到界面
-                    data.messages.forEach((msg, index) => {
-                        // 如果需要跳过这条消息
-                        if (skipNext) {
-                            skipNext = false;
-                            return;
-                        }
-                        
-                        if (msg.role === 'user') {
-                            // 检查是否包含图片
-                            let imageSrc = null;
-                            let textContent = msg.content;
-                            
-                            // 如果内容是数组（可能包含图片）
-                            if (Array.isArray(msg.content)) {
-                                // 提取文本内容
-                                const textPart = msg.content.find(part => part.type === 'text');
-                                textContent = textPart ? textPart.text : '';
-                                
-                                // 提取图片URL或路径
-                                const imagePart = msg.content.find(part => part.type === 'image_url' || part.type === 'image');
-                                if (imagePart) {
-                                    if (imagePart.type === 'image_url' && imagePart.image_url) {
-                                        imageSrc = imagePart.image_url.url;
-                                    } else if (imagePart.type === 'image' && imagePart.image_path) {
-                                        imageSrc = '/' + imagePart.image_path;
-                                    }
-                                }
-                                
-                                // 检查下一条消息是否是同一个用户发送的消息（文本版本）
-                                if (index + 1 < data.messages.length && 
-                                    data.messages[index + 1].role === 'user' && 
-                                    typeof data.messages[index + 1].content === 'string') {
-                                    // 标记跳过下一条消息，因为它只是为了兼容性而添加的文本版本
-                                    skipNext = true;
-                                }
-                            }
-                            
-                            // 决定是否显示这条消息
-                            if (textContent || imageSrc) {
-                                appendMessage('user', textContent, imageSrc);
-                            }
-                        } else if (msg.role === 'assistant') {
-                            appendMessage('assistant', msg.content);
-                        } else if (msg.role === 'system') {
-                            appendSystemMessage(msg.content);
-                        }
-                    });
+                    renderHistoryMessages(data.messages);
                     
                     // 更新token计数
                     if (data.token_count) {
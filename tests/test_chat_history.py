@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, session_data):
+        self.row = {'id': 5, 'session_data': session_data, 'summary': None, 'summary_upto_seq': 0}
+        self.query = ''
+
+    def execute(self, query, params=None):
+        self.query = query
+
+    def fetchone(self):
+        return self.row
+
+    def fetchall(self):
+        # chat_messages中没有迁移后的消息
+        return []
+
+
+class FakeConnection:
+    def __init__(self, session_data):
+        self._cursor = FakeCursor(session_data)
+
+    def cursor(self, dictionary=False):
+        return self._cursor
+
+    def close(self):
+        pass
+
+
+def contents(messages):
+    return [(m['role'], m['content']) for m in messages]
+
+
+def load_legacy(monkeypatch, session_data):
+    monkeypatch.setattr(app, 'get_db_connection', lambda: FakeConnection(session_data))
+    return app.load_user_session(7, 5)
+
+
+def test_legacy_session_data_as_bare_list(monkeypatch):
+    messages = [{'role': 'user', 'content': '你好'}, {'role': 'assistant', 'content': '你好！'}]
+    result = load_legacy(monkeypatch, json.dumps(messages))
+    assert result['success']
+    assert contents(result['messages']) == contents(messages)
+
+
+def test_legacy_session_data_with_user_key(monkeypatch):
+    messages = [{'role': 'user', 'content': 'hi'}]
+    result = load_legacy(monkeypatch, json.dumps({'messages_7': messages}))
+    assert result['success']
+    assert contents(result['messages']) == contents(messages)
+
+
+def test_corrupt_legacy_session_data_is_an_error(monkeypatch):
+    result = load_legacy(monkeypatch, '{not json')
+    assert not result['success']
@@ -0,0 +1,36 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from flask import session  # noqa: E402
+
+
+def open_session(cookie):
+    headers = {'Cookie': f"{app.app.config['SESSION_COOKIE_NAME']}={cookie}"} if cookie else {}
+    with app.app.test_request_context('/', headers=headers) as ctx:
+        return app.app.session_interface.open_session(app.app, ctx.request)
+
+
+def test_client_chosen_session_id_is_rejected():
+    assert open_session('attacker-chosen-id').sid != 'attacker-chosen-id'
+
+
+def test_signed_session_id_round_trips():
+    client = app.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 42
+        sid = sess.sid
+    cookie = client.get_cookie(app.app.config['SESSION_COOKIE_NAME']).value
+    assert cookie != sid
+    assert open_session(cookie).sid == sid
+
+
+def test_regenerate_session_assigns_new_id():
+    with app.app.test_request_context('/'):
+        session['next'] = 'x'
+        old_sid = session.sid
+        app.regenerate_session()
+        assert session.sid != old_sid
+        assert 'next' not in session
@@ -0,0 +1,18 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def test_filesystem_send_slot_is_released_after_expiry(tmp_path):
+    store = app.FileSystemCodeStore(str(tmp_path / 'codes'))
+
+    assert store.acquire_send_slot('13800000000', 'login', interval=1)
+    assert not store.acquire_send_slot('13800000000', 'login', interval=1)
+    assert store.send_wait_seconds('13800000000', 'login') >= 1
+
+    time.sleep(1.1)
+    assert store.acquire_send_slot('13800000000', 'login', interval=1)
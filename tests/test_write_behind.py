@@ -0,0 +1,91 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+def msg(role, content):
+    return {'role': role, 'content': content}
+
+
+class FakeStore:
+    """按store_chat_messages的规则追加消息：base_seq之后的内容不一致时追加在已有消息之后"""
+
+    def __init__(self, stored=None, block_first=False):
+        self.rows = {1: list(stored or [])}
+        self.calls = []
+        self.release = threading.Event()
+        if not block_first:
+            self.release.set()
+
+    def write(self, user_id, messages, chat_id, base_seq):
+        self.release.wait(5)
+        self.calls.append((chat_id, [m['content'] for m in messages], base_seq))
+        rows = self.rows.setdefault(chat_id, [])
+        base = min(base_seq, len(rows))
+        tail, snapshot_tail = rows[base:], messages[base:]
+        if all(app.same_message(a, b) for a, b in zip(tail, snapshot_tail)) and len(tail) <= len(snapshot_tail):
+            rows.extend(snapshot_tail[len(tail):])
+        else:
+            rows.extend(snapshot_tail)
+
+
+def test_divergent_snapshots_are_written_in_order():
+    history = [msg('system', 's1'), msg('assistant', 'a1')]
+    store = FakeStore(stored=history, block_first=True)
+    queue = app.WriteBehindQueue(store.write, retry_delay=0.01)
+
+    # 占住写入线程，让后面两轮基于同一段历史的快照同时排队
+    queue.enqueue(2, 7, [msg('user', 'busy')], 0)
+    queue.enqueue(1, 7, history + [msg('user', 'uA'), msg('assistant', 'aA')], 2)
+    queue.enqueue(1, 7, history + [msg('user', 'uB'), msg('assistant', 'aB')], 2)
+    assert [m['content'] for m in queue.pending_messages(1)] == ['s1', 'a1', 'uA', 'aA', 'uB', 'aB']
+
+    store.release.set()
+    assert queue.flush(5)
+    assert [m['content'] for m in store.rows[1]] == ['s1', 'a1', 'uA', 'aA', 'uB', 'aB']
+    assert queue.pending_messages(1) is None
+
+
+def test_extending_snapshot_is_coalesced():
+    store = FakeStore(block_first=True)
+    queue = app.WriteBehindQueue(store.write, retry_delay=0.01)
+    turn1 = [msg('user', 'u1'), msg('assistant', 'a1')]
+
+    queue.enqueue(2, 7, [msg('user', 'busy')], 0)
+    queue.enqueue(1, 7, turn1, 0)
+    queue.enqueue(1, 7, turn1 + [msg('user', 'u2'), msg('assistant', 'a2')], 2)
+    store.release.set()
+
+    assert queue.flush(5)
+    assert [call for call in store.calls if call[0] == 1] == [(1, ['u1', 'a1', 'u2', 'a2'], 0)]
+    assert queue.stats()['coalesced'] == 1
+
+
+def test_permanent_error_is_dropped_and_retries_do_not_block_other_chats():
+    attempts = {'missing': 0, 'flaky': 0}
+    written = []
+
+    def write(user_id, messages, chat_id, base_seq):
+        if chat_id == 'missing':
+            attempts['missing'] += 1
+            raise app.ChatHistoryNotFoundError('gone')
+        if chat_id == 'flaky' and attempts['flaky'] < 1:
+            attempts['flaky'] += 1
+            raise ConnectionError('db down')
+        written.append(chat_id)
+
+    queue = app.WriteBehindQueue(write, retry_delay=0.2, permanent_errors=(app.ChatHistoryNotFoundError,))
+    queue.enqueue('missing', 7, [msg('user', 'x')], 0)
+    queue.enqueue('flaky', 7, [msg('user', 'y')], 0)
+    queue.enqueue('ok', 7, [msg('user', 'z')], 0)
+
+    assert queue.flush(5)
+    assert attempts['missing'] == 1
+    # 失败的对话等待重试期间，其他对话先写入
+    assert written == ['ok', 'flaky']
+    stats = queue.stats()
+    assert stats['dropped'] == 1 and stats['written'] == 2
@@ -26,14 +26,87 @@ CREATE TABLE `chat_histories`  (
   `user_id` int NOT NULL,
   `title` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
   `session_data` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NULL,
+  `summary` text CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NULL,
+  `summary_upto_seq` int NOT NULL DEFAULT 0,
   `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
   `updated_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   `is_active` tinyint(1) NULL DEFAULT 1,
   PRIMARY KEY (`id`) USING BTREE,
   INDEX `user_id_idx`(`user_id`) USING BTREE,
+  INDEX `user_updated_idx`(`user_id`, `updated_at`, `id`) USING BTREE,
   CONSTRAINT `fk_chat_histories_user_id` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
 ) ENGINE = InnoDB AUTO_INCREMENT = 19 CHARACTER SET = utf8mb4 COLLATE = utf8mb4_general_ci ROW_FORMAT = DYNAMIC;
 
+-- ----------------------------
+-- Table structure for chat_uploads
+-- ----------------------------
+DROP TABLE IF EXISTS `chat_uploads`;
+CREATE TABLE `chat_uploads`  (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `chat_history_id` int NOT NULL,
+  `user_id` int NOT NULL,
+  `content_hash` char(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`) USING BTREE,
+  UNIQUE INDEX `chat_hash_idx`(`chat_history_id`, `content_hash`) USING BTREE,
+  INDEX `content_hash_idx`(`content_hash`) USING BTREE,
+  CONSTRAINT `fk_chat_uploads_chat_history_id` FOREIGN KEY (`chat_history_id`) REFERENCES `chat_histories` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE = InnoDB AUTO_INCREMENT = 1 CHARACTER SET = utf8mb4 COLLATE = utf8mb4_general_ci ROW_FORMAT = DYNAMIC;
+
+-- ----------------------------
+-- Table structure for chat_messages
+-- ----------------------------
+DROP TABLE IF EXISTS `chat_messages`;
+CREATE TABLE `chat_messages`  (
+  `id` bigint NOT NULL AUTO_INCREMENT,
+  `chat_history_id` int NOT NULL,
+  `user_id` int NOT NULL,
+  `seq` int NOT NULL,
+  `role` varchar(20) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
+  `content` longtext CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
+  `content_blob` longblob NULL,
+  `content_format` varchar(10) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL DEFAULT 'text',
+  `token_count` int NOT NULL DEFAULT 0,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`) USING BTREE,
+  UNIQUE INDEX `chat_seq_idx`(`chat_history_id`, `seq`) USING BTREE,
+  CONSTRAINT `fk_chat_messages_chat_history_id` FOREIGN KEY (`chat_history_id`) REFERENCES `chat_histories` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE = InnoDB AUTO_INCREMENT = 1 CHARACTER SET = utf8mb4 COLLATE = utf8mb4_general_ci ROW_FORMAT = DYNAMIC;
+
+-- ----------------------------
+-- Table structure for user_token_usage
+-- ----------------------------
+DROP TABLE IF EXISTS `user_token_usage`;
+CREATE TABLE `user_token_usage`  (
+  `user_id` int NOT NULL,
+  `usage_date` date NOT NULL,
+  `prompt_tokens` bigint NOT NULL DEFAULT 0,
+  `completion_tokens` bigint NOT NULL DEFAULT 0,
+  `requests` int NOT NULL DEFAULT 0,
+  `updated_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`user_id`, `usage_date`) USING BTREE,
+  CONSTRAINT `fk_user_token_usage_user_id` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE = InnoDB CHARACTER SET = utf8mb4 COLLATE = utf8mb4_general_ci ROW_FORMAT = DYNAMIC;
+
+-- ----------------------------
+-- Table structure for user_uploads
+-- ----------------------------
+DROP TABLE IF EXISTS `user_uploads`;
+CREATE TABLE `user_uploads`  (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `user_id` int NOT NULL,
+  `content_hash` char(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
+  `stored_name` varchar(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
+  `original_name` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NULL DEFAULT NULL,
+  `file_size` int NOT NULL DEFAULT 0,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  `last_used_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`) USING BTREE,
+  UNIQUE INDEX `user_hash_idx`(`user_id`, `content_hash`) USING BTREE,
+  INDEX `content_hash_idx`(`content_hash`) USING BTREE,
+  CONSTRAINT `fk_user_uploads_user_id` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE ON UPDATE CASCADE
+) ENGINE = InnoDB AUTO_INCREMENT = 1 CHARACTER SET = utf8mb4 COLLATE = utf8mb4_general_ci ROW_FORMAT = DYNAMIC;
+
 -- ----------------------------
 -- Table structure for user_sessions
 -- ----------------------------
@@ -59,12 +132,13 @@ CREATE TABLE `users`  (
   `id` int NOT NULL AUTO_INCREMENT,
   `username` varchar(50) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
   `phone` varchar(20) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
-  `password_hash` varchar(128) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
+  `password_hash` varchar(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NOT NULL,
   `email` varchar(100) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NULL DEFAULT NULL,
   `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
   `last_login` timestamp NULL DEFAULT NULL,
   `is_active` tinyint(1) NULL DEFAULT 1,
   `role` varchar(20) CHARACTER SET utf8mb4 COLLATE utf8mb4_general_ci NULL DEFAULT 'user',
+  `response_cache_enabled` tinyint(1) NOT NULL DEFAULT 1,
   PRIMARY KEY (`id`) USING BTREE,
   UNIQUE INDEX `username`(`username`) USING BTREE,
   UNIQUE INDEX `phone`(`phone`) USING BTREE